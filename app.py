@@ -1,171 +1,286 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, send_file, g, url_for, abort, stream_with_context
+from PIL import Image
 import os
-import cv2
-from sklearn.cluster import KMeans
+import io
+import base64
+import json
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import exports
+import instructions
+import metrics
+import quantize
+import refine
+import renderer
+import pipeline
+import yarns
+from pipeline import decode_factor, decode_image, render_pattern_png
+from cache import LRUCache, content_hash
+from pattern import Pattern
+import colorspace
+from fonts import font_cache
+from jobs import JobQueue, QueueFull
+from sessions import PatternStore, is_session_id, new_session_id, remove_session_dir
 
 app = Flask(__name__)
 
+# Run as a script, this module is imported again as __mp_main__ by every pool
+# worker (spawn); they only need pipeline.py, so the startup work is skipped there
+POOL_WORKER = __name__ == '__mp_main__'
+
 # Ensure output directory exists
 os.makedirs('static/output', exist_ok=True)
 os.makedirs('static/uploads', exist_ok=True)
 
-# Global variables to store current pattern and colors
-current_pattern = None
-current_colors = []
-current_indices = None
+# Load fonts and pre-render color numbers (preview and chart sizes) and axis labels
+if not POOL_WORKER:
+    font_cache.preload(number_sizes=(8, 15), label_sizes=(10, 16), text_sizes=(16, 24),
+                       max_number=20, max_label=200)
+
+# Content-addressed caches: (upload hash, decode reduction) -> decoded RGB image, and
+# (hash, width, height, num_colors, algorithm, color space, yarn ids) -> pattern, palette and
+# preview PNG; /generate_variants appends 'variant' to the keys of its results
+image_cache = LRUCache(int(os.environ.get('IMAGE_CACHE_BYTES', 256 * 1024 * 1024)), 'images')
+result_cache = LRUCache(int(os.environ.get('RESULT_CACHE_BYTES', 256 * 1024 * 1024)), 'results')
+# (upload hash, source image, width, height) -> packed Lab pixels of the upload
+# resized to that grid. Converted here rather than in the pool, whose workers
+# each have their own caches, and sent with the job (see lab_payload).
+lab_cache = LRUCache(int(os.environ.get('LAB_CACHE_BYTES', 64 * 1024 * 1024)), 'lab')
+# Session id -> cached layers of the printable chart (see renderer.ChartLayers)
+layer_cache = LRUCache(int(os.environ.get('LAYER_CACHE_BYTES', 256 * 1024 * 1024)), 'layers')
+# Export tag -> encoded color list, gauge or WebP chart (see exports.py); PNG
+# charts are kept by the chart layers, which can swap their palette on color edits
+export_cache = LRUCache(int(os.environ.get('EXPORT_CACHE_BYTES', 64 * 1024 * 1024)), 'exports')
+
+OUTPUT_ROOT = 'static/output'
+SESSION_COOKIE = 'pattern_session'
+
+def cleanup_session(session_id):
+    """Remove the output files of an expired session."""
+    remove_session_dir(OUTPUT_ROOT, session_id)
+
+# Pattern state per browser session (see sessions.py). Point SESSION_SPILL_DIR
+# at a directory shared by all workers when running more than one process.
+pattern_store = PatternStore(
+    ttl=int(os.environ.get('SESSION_TTL', 3600)),
+    max_bytes=int(os.environ.get('SESSION_MAX_BYTES', 512 * 1024 * 1024)),
+    spill_dir=os.environ.get('SESSION_SPILL_DIR') or None,
+    on_expire=cleanup_session
+)
+
+# Quantizing and rendering run in worker processes; /generate hands back a job id
+job_queue = JobQueue(
+    max_workers=int(os.environ.get('JOB_WORKERS', 0)) or None,
+    max_pending=int(os.environ.get('JOB_QUEUE_DEPTH', 0)) or None,
+    status_dir=os.path.join(pattern_store.spill_dir, 'jobs') if pattern_store.spill_dir else None
+)
+# Yarn catalog (CSV or JSON, see yarns.py) to match pattern colors against;
+# its KD-tree is built once here and shared by all requests
+YARN_CATALOG = os.environ.get('YARN_CATALOG')
+yarn_catalog = yarns.load_catalog(YARN_CATALOG) if YARN_CATALOG and not POOL_WORKER else None
+
+GENERATE_STAGES = [('quantizing', pipeline.quantize_stage), ('rendering', pipeline.render_stage)]
+VARIANT_STAGES = [('quantizing', pipeline.variants_stage)]
+
+# /generate_variants: most parameter sets per request, and how long the request waits for them
+MAX_VARIANTS = int(os.environ.get('MAX_VARIANTS', 12))
+VARIANT_TIMEOUT = float(os.environ.get('VARIANT_TIMEOUT', 120))
+# Variant id -> result cache key, so /use_variant can pick a variant by id
+variant_keys = LRUCache(1024 * 1024, 'variants')
+
+def get_session_id():
+    """Id of the requesting browser session, assigning a new one if needed."""
+    session_id = g.get('session_id')
+    if session_id is None:
+        session_id = request.cookies.get(SESSION_COOKIE)
+        if not is_session_id(session_id):
+            session_id = new_session_id()
+            g.new_session = True
+        g.session_id = session_id
+    return session_id
+
+@app.after_request
+def set_session_cookie(response):
+    if g.get('new_session'):
+        response.set_cookie(SESSION_COOKIE, g.session_id, httponly=True, samesite='Lax')
+    return response
+
+# Per-request profiling, opted into with an X-Profile header or ?profile= query
+# flag ("pyinstrument" picks pyinstrument when installed). Off unless
+# PROFILE_REQUESTS=1, since a profiled request is several times slower.
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'knitting-profiles')
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    if PROFILE_REQUESTS:
+        flag = request.headers.get('X-Profile') or request.args.get('profile')
+        if flag:
+            g.profiler = metrics.RequestProfiler(flag)
+            g.profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed bodies are produced after this point and are not included
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        response.headers['X-Profile-Path'] = profiler.dump(PROFILE_DIR, request.endpoint or 'unmatched')
+    start = g.get('request_start')
+    if start is not None:
+        metrics.request_seconds.observe(time.perf_counter() - start, route=route,
+                                        method=request.method, status=str(response.status_code))
+    if response.status_code >= 400:
+        metrics.record_error(route, f'http_{response.status_code}')
+    return response
+
+def session_output_path(session_id, filename):
+    """Path of an output file in the session's own directory."""
+    directory = os.path.join(OUTPUT_ROOT, session_id)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+def session_output_url(session_id, filename):
+    return url_for('session_output', session_id=session_id, filename=filename)
+
+@contextmanager
+def chart_layers(session_id, state):
+    """Chart layers of a session (cached if it has any), pointed at its current pattern.
 
-def process_image(image_path, grid_size, num_colors):
-    """Process input image to create knitting pattern."""
-    # Load and process image
-    image = cv2.imread(image_path)
+    The layers stay pinned to the pattern for the block, so a concurrent
+    request for the session cannot swap in its own pattern before these
+    are rendered. They are kept in layer_cache afterwards.
+    """
+    layers = layer_cache.get(session_id) if session_id is not None else None
+    if layers is None:
+        layers = renderer.ChartLayers('chart')
+    with layers.pinned(state['pattern'].indices, state['pattern'].colors):
+        yield layers
+    if session_id is not None:
+        layer_cache.put(session_id, layers)
+
+def selected_yarns(ids):
+    """The catalog yarns with the given ids, or all of them without ids.
+
+    Only looks the yarns up; a KD-tree over them is built where they are
+    matched. Raises LookupError without a catalog or for unknown ids.
+    """
+    if yarn_catalog is None:
+        raise LookupError('No yarn catalog is configured')
+    ids = [i.strip() for i in ids if i.strip()]
+    return yarn_catalog.lookup(ids) if ids else yarn_catalog.yarns
+
+def result_colors(pattern, matched_yarns=None):
+    """Palette as sent to the page, with the matched yarn of each color if known."""
+    colors = pattern.colors
+    for color, yarn in zip(colors, matched_yarns or ()):
+        color['yarn'] = yarn
+    return colors
+
+def decoded_image(data, digest, grid_size):
+    """Decoded upload at the smallest resolution that still covers grid_size.
+
+    The reduction is part of the cache key since it changes the decoded
+    pixels. Raises ValueError for undecodable data.
+    """
+    factor = decode_factor(data, grid_size)
+    image = image_cache.get((digest, factor))
     if image is None:
-        raise ValueError(f"Could not load image: {image_path}")
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    # Convert grid_size to integers and ensure positive values
-    width, height = map(int, grid_size)
-    if width <= 0 or height <= 0:
-        raise ValueError("Width and height must be positive numbers")
-    
-    # Resize the image
-    grid_size = (width, height)  # Already integers from map(int, grid_size)
-    resized_image = cv2.resize(image, grid_size, interpolation=cv2.INTER_AREA)
-    
-    # Color clustering
-    pixels = resized_image.reshape((-1, 3))
-    kmeans = KMeans(n_clusters=int(num_colors), random_state=42, n_init=10)
-    kmeans.fit(pixels)
-    clustered_pixels = kmeans.cluster_centers_[kmeans.labels_]
-    
-    # Create pattern grid with color indices
-    pattern_indices = kmeans.labels_.reshape(height, width).astype(np.int32)
-    pattern = clustered_pixels.reshape(resized_image.shape).astype(np.uint8)
-    
-    # Generate color mapping
-    colors = []
-    for i, center in enumerate(kmeans.cluster_centers_):
-        colors.append({
-            'number': i + 1,
-            'rgb': [int(x) for x in center]
-        })
+        image = decode_image(data, factor)
+        image.setflags(write=False)
+        image_cache.put((digest, factor), image)
+    return image
+
+def lab_payload(image, digest, source, grid_size, color_space):
+    """Job payload fields for quantizing image to grid_size.
+
+    For Lab the image is resized here, and its Lab pixels come from
+    lab_cache by digest, source (what image was made from the upload) and
+    grid size, so every worker gets them without converting.
+    """
+    if color_space != 'lab':
+        return {'image': image}
+    resized = pipeline.resize_to_grid(image, grid_size)
+    key = (digest, source) + tuple(map(int, grid_size))
+    lab8 = lab_cache.get(key)
+    if lab8 is None:
+        with metrics.span('convert.lab'):
+            lab8 = colorspace.to_lab8(resized)
+        lab8.setflags(write=False)
+        lab_cache.put(key, lab8)
+    return {'image': resized, 'lab': lab8}
+
+# Downloadable images of a pattern and their file names without extension
+EXPORT_ITEMS = {'pattern': 'knitting_pattern', 'color_list': 'color_list', 'gauge': 'gauge_calculation'}
+# Export URLs stay the same while the pattern changes, so clients revalidate
+# every time; an unchanged pattern then costs a 304 without rendering anything
+EXPORT_CACHE_CONTROL = 'private, no-cache'
+
+def export_image(session_id, state, item, image_format='png', show_numbers=True):
+    """Encoded export image of a session's pattern, reused while the pattern is unchanged."""
+    pattern = state['pattern']
+    if item == 'pattern' and image_format == 'png':
+        with chart_layers(session_id, state) as layers:
+            return exports.chart_bytes(layers, show_numbers)
+    tag = exports.export_tag(exports.pattern_digest(pattern), item, image_format,
+                             show_numbers if item == 'pattern' else None)
+    data = export_cache.get(tag)
+    if data is None:
+        if item == 'pattern':
+            with chart_layers(session_id, state) as layers:
+                data = exports.chart_bytes(layers, show_numbers, image_format)
+        elif item == 'color_list':
+            data = exports.encode_image(renderer.render_color_list(pattern.colors), image_format)
+        else:
+            height, width = pattern.shape
+            data = exports.encode_image(renderer.render_gauge(width, height), image_format)
+        export_cache.put(tag, data)
+    return data
+
+def request_flag(name, default):
+    """Boolean query argument (1, true, yes or on), or default when it is missing."""
+    value = request.args.get(name)
+    return default if value is None else value.lower() in ('1', 'true', 'yes', 'on')
+
+def tagged_response(body, mimetype, tag, filename=None):
+    """Export response validated by tag; a 304 when the client already has it.
     
-    return pattern, pattern_indices, colors
+    body is called only when the content has to be sent.
+    """
+    if request.if_none_match.contains_weak(tag):
+        response = Response(status=304)
+    else:
+        response = Response(body(), mimetype=mimetype)
+        if filename:
+            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = EXPORT_CACHE_CONTROL
+    return response
 
 def save_pattern_image(pattern, pattern_indices, colors, output_path='static/output/pattern.png', scale=20, show_numbers=True):
     """Convert pattern array to image and save it."""
-    # Ensure dimensions are integers
-    height, width = int(pattern_indices.shape[0]), int(pattern_indices.shape[1])
-    # Create a larger image to accommodate ticks
-    margin = int(80)  # Increased margin
-    bottom_margin = int(50)  # Reduced bottom margin since we don't need space for rotated numbers
-    img_width = int(width * scale + margin * 2)
-    img_height = int(height * scale + margin + bottom_margin)
-    image = Image.new('RGB', (img_width, img_height), 'white')
-    draw = ImageDraw.Draw(image)
-    
-    # Draw the pattern and color numbers
-    font_small = ImageFont.truetype("arial.ttf", int(scale * 0.4))  # Adjusted font size
-    for y in range(height):
-        for x in range(width):
-            color_idx = int(pattern_indices[y, x])  # Ensure color index is integer
-            rgb = tuple(map(int, colors[color_idx]['rgb']))  # Ensure RGB values are integers
-            # Draw a filled rectangle for each pixel
-            rect = [
-                (int(x * scale + margin), int(y * scale + margin)),
-                (int((x + 1) * scale + margin - 1), int((y + 1) * scale + margin - 1))
-            ]
-            draw.rectangle(rect, fill=rgb, outline='black')  # Added black outline
-            
-            # Add color number if enabled
-            if show_numbers:
-                number = str(colors[color_idx]['number'])
-                # Get text size for centering
-                text_bbox = draw.textbbox((0, 0), number, font=font_small)
-                text_width = int(text_bbox[2] - text_bbox[0])
-                text_height = int(text_bbox[3] - text_bbox[1])
-                
-                # Calculate center position for text
-                text_x = int(x * scale + margin + (scale - text_width) // 2)
-                text_y = int(y * scale + margin + (scale - text_height) // 2)
-                
-                # Draw number with white background for better visibility
-                padding = 2
-                bg_rect = [
-                    int(text_x - padding), int(text_y - padding),
-                    int(text_x + text_width + padding), int(text_y + text_height + padding)
-                ]
-                draw.rectangle(bg_rect, fill='white')
-                
-                # Then draw the number in black
-                draw.text((text_x, text_y), number, fill='black', font=font_small)
-    
-    # Draw tick marks and numbers
-    font = ImageFont.truetype("arial.ttf", 10)  # Reduced font size from 14 to 10
-    
-    # Vertical ticks (for rows) - on the right side, counting from bottom to top
-    for i in range(height):
-        y_pos = int((height - i - 1) * scale + margin)  # Reverse the y-position
-        number = str(i + 1)  # Start from 1
-        
-        # Draw tick mark in the middle of the bin
-        tick_y = int(y_pos + scale // 2)
-        draw.line([
-            (int(width * scale + margin), tick_y),
-            (int(width * scale + margin + 5), tick_y)
-        ], fill='black')
-        
-        # Draw number
-        text_bbox = draw.textbbox((0, 0), number, font=font)
-        text_width = int(text_bbox[2] - text_bbox[0])
-        draw.text(
-            (int(width * scale + margin + 10), int(tick_y - 5)),  # Adjusted y offset for smaller font
-            number,
-            fill='black',
-            font=font
-        )
-    
-    # Horizontal ticks (for columns) - at the bottom, counting from right to left
-    for i in range(width):
-        x_pos = int((width - i - 1) * scale + margin)  # Reverse the x-position
-        number = str(i + 1)  # Start from 1
-        
-        # Draw tick mark in the middle of the bin
-        tick_x = int(x_pos + scale // 2)
-        draw.line([
-            (tick_x, int(height * scale + margin)),
-            (tick_x, int(height * scale + margin + 5))
-        ], fill='black')
-        
-        # Draw number horizontally
-        text_bbox = draw.textbbox((0, 0), number, font=font)
-        text_width = int(text_bbox[2] - text_bbox[0])
-        text_height = int(text_bbox[3] - text_bbox[1])
-        
-        # Center the number under the tick mark
-        text_x = int(tick_x - text_width // 2)
-        text_y = int(height * scale + margin + 8)  # Adjusted spacing for smaller font
-        
-        draw.text((text_x, text_y), number, fill='black', font=font)
-    
-    # Draw border
-    draw.rectangle([
-        (margin, margin),
-        (int(width * scale + margin - 1), int(height * scale + margin - 1))
-    ], outline='black', width=2)  # Made border thicker
-    
-    image.save(output_path)
+    with open(output_path, 'wb') as f:
+        f.write(render_pattern_png(pattern_indices, colors, scale, show_numbers))
     return output_path
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/output/<session_id>/<filename>')
+def session_output(session_id, filename):
+    """Serve a file rendered for one session"""
+    if not is_session_id(session_id):
+        abort(404)
+    return send_from_directory(os.path.join(OUTPUT_ROOT, session_id), filename)
+
 @app.route('/generate', methods=['POST'])
 def generate():
-    global current_pattern, current_colors, current_indices
-    
     if 'image' not in request.files:
         return jsonify({'error': 'No image uploaded'}), 400
     
@@ -173,9 +288,9 @@ def generate():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    # Save uploaded image
-    image_path = os.path.join('static/uploads', file.filename)
-    file.save(image_path)
+    # Uploads are identified by content, so repeats skip decoding and clustering
+    data = file.read()
+    digest = content_hash(data)
     
     # Get parameters and convert to integers
     try:
@@ -183,63 +298,395 @@ def generate():
         height = int(float(request.form.get('height', 110)))
         grid_size = (width, height)  # OpenCV resize expects (width, height)
         num_colors = int(request.form.get('num_colors', 7))
+        algorithm = request.form.get('algorithm', quantize.DEFAULT_ALGORITHM)
+        color_space = request.form.get('colorspace', quantize.DEFAULT_COLORSPACE)
+        yarn_ids = request.form.get('yarns', '').split(',')
         
         if width <= 0 or height <= 0:
             return jsonify({'error': 'Width and height must be positive numbers'}), 400
+        if num_colors <= 0:
+            return jsonify({'error': 'Number of colors must be a positive number'}), 400
+        if algorithm not in quantize.BACKENDS:
+            return jsonify({'error': f'Unknown quantization algorithm: {algorithm}'}), 400
+        if color_space not in colorspace.COLORSPACES:
+            return jsonify({'error': f'Unknown color space: {color_space}'}), 400
+        
+        # Quantize against chosen catalog yarns instead of free colors
+        palette_yarns = None
+        if any(i.strip() for i in yarn_ids):
+            try:
+                palette_yarns = selected_yarns(yarn_ids)
+            except LookupError as e:
+                return jsonify({'error': e.args[0]}), 400
             
-        # Process image and generate pattern
-        current_pattern, current_indices, current_colors = process_image(image_path, grid_size, num_colors)
+        key = (digest, width, height, num_colors, algorithm, color_space,
+               tuple(yarn['id'] for yarn in palette_yarns) if palette_yarns else None)
+        session_id = get_session_id()
+        pattern_url = session_output_url(session_id, 'pattern.png')
+        result = result_cache.get(key)
+        if result is not None:
+            publish_result(session_id, result, key)
+            return jsonify({
+                'job_id': None,
+                'status': 'done',
+                'colors': result_colors(result['pattern'], result.get('yarns')),
+                'pattern_path': pattern_url,
+                'cached': True
+            })
         
-        # Save the pattern as an image
-        output_path = save_pattern_image(current_pattern, current_indices, current_colors)
+        try:
+            image = decoded_image(data, digest, grid_size)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({
-            'colors': current_colors,
-            'pattern_path': output_path
-        })
+        def finish(job, result):
+            result_cache.put(key, result)
+            publish_result(session_id, result, key)
+            job.result = {'colors': result_colors(result['pattern'], result.get('yarns')),
+                          'pattern_path': pattern_url, 'cached': False}
+        
+        # Process image and generate pattern in the worker pool
+        payload = {'grid_size': grid_size, 'num_colors': num_colors, 'algorithm': algorithm,
+                   'color_space': color_space, 'yarns': palette_yarns}
+        if palette_yarns:  # yarn matching does not use the color space
+            payload['image'] = image
+        else:
+            payload.update(lab_payload(image, digest, image.shape[:2], grid_size, color_space))
+        try:
+            job = job_queue.submit(payload, GENERATE_STAGES, session_id=session_id, on_done=finish)
+        except QueueFull:
+            response = jsonify({'error': 'The server is busy, please try again in a moment.'})
+            response.headers['Retry-After'] = '2'
+            return response, 429
+        
+        status = job.to_dict()
+        status['status_url'] = url_for('job_status', job_id=job.id)
+        return jsonify(status), 202
     except ValueError as e:
         return jsonify({'error': 'Invalid dimensions or number of colors. Please enter valid numbers.'}), 400
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'error': str(e)}), 500
 
+def publish_result(session_id, result, key=None):
+    """Make a generated result (cached under key) the session's current pattern."""
+    if 'png' not in result:
+        # Variants are quantized without a preview; it is rendered once one is picked
+        result['png'] = render_pattern_png(result['pattern'].indices, result['pattern'].colors)
+        if key is not None:
+            result_cache.put(key, result)
+    metrics.record_pattern(result['pattern'].shape, result['pattern'].num_colors)
+    # The cached entry stays untouched by later color edits
+    state = {
+        'pattern': result['pattern'].copy(),
+        'show_numbers': True,
+        'preview': result['png'],
+        'source': key,
+        'base': result['pattern'],
+        'image': result.get('image')
+    }
+    pattern_store.put(session_id, state)
+    
+    # Save the pattern as an image
+    with open(session_output_path(session_id, 'pattern.png'), 'wb') as f:
+        f.write(result['png'])
+    return state
+
+def variant_id(key):
+    """Short id of a variant, derived from its result cache key."""
+    return content_hash(repr(key).encode())[:16]
+
+@app.route('/generate_variants', methods=['POST'])
+def generate_variants():
+    """Quantize one upload at several grid sizes and color counts in one request.
+    
+    The upload is decoded once and halved into a pyramid, so each grid size is
+    resized from the smallest level covering it. The grid sizes are shared
+    out between at most one job per pool worker, and with a KMeans backend
+    each grid's color counts run in ascending order, each warm-started from
+    the previous count's colors.
+    Returns an id and thumbnail per variant; POST an id to /use_variant to
+    make that variant the current pattern.
+    """
+    started = time.perf_counter()
+    file = request.files.get('image')
+    if file is None or file.filename == '':
+        return jsonify({'error': 'No image uploaded'}), 400
+    data = file.read()
+    digest = content_hash(data)
+    
+    try:
+        variants = [(int(float(v['width'])), int(float(v['height'])), int(v['num_colors']))
+                    for v in json.loads(request.form.get('variants', '[]'))]
+    except (TypeError, ValueError, KeyError):
+        return jsonify({'error': 'variants must be a JSON list of {"width", "height", "num_colors"} objects'}), 400
+    variants = list(dict.fromkeys(variants))
+    algorithm = request.form.get('algorithm', quantize.DEFAULT_ALGORITHM)
+    color_space = request.form.get('colorspace', quantize.DEFAULT_COLORSPACE)
+    if not variants:
+        return jsonify({'error': 'No variants given'}), 400
+    if len(variants) > MAX_VARIANTS:
+        return jsonify({'error': f'At most {MAX_VARIANTS} variants per request'}), 400
+    if any(width <= 0 or height <= 0 or num_colors <= 0 for width, height, num_colors in variants):
+        return jsonify({'error': 'Width, height and number of colors must be positive numbers'}), 400
+    if algorithm not in quantize.BACKENDS:
+        return jsonify({'error': f'Unknown quantization algorithm: {algorithm}'}), 400
+    if color_space not in colorspace.COLORSPACES:
+        return jsonify({'error': f'Unknown color space: {color_space}'}), 400
+    
+    # Variants are warm-started and resized from the pyramid, so their
+    # palettes can differ from /generate's; they are cached apart from it
+    keys = {v: (digest, v[0], v[1], v[2], algorithm, color_space, None, 'variant') for v in variants}
+    results = {v: result_cache.get(keys[v]) for v in variants}
+    cached = {v for v in variants if results[v] is not None}
+    
+    # Grid sizes to quantize, each with its color counts in ascending order;
+    # backends that cannot be warm-started get one job per variant instead
+    chains = {}
+    for width, height, num_colors in sorted(v for v in variants if v not in cached):
+        chain = (width, height) if algorithm in quantize.WARM_STARTS else (width, height, num_colors)
+        chains.setdefault(chain, []).append(num_colors)
+    
+    jobs = []
+    if chains:
+        missing = [v for v in variants if v not in cached]
+        try:
+            image = decoded_image(data, digest, (max(v[0] for v in missing), max(v[1] for v in missing)))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        levels = pipeline.build_pyramid(image, (min(v[0] for v in missing), min(v[1] for v in missing)))
+        
+        # Chains go to at most one job per pool worker, largest first onto the
+        # least loaded job, so a request takes no more queue slots than the
+        # pool can run at once
+        batches = [[] for _ in range(min(len(chains), job_queue.max_workers))]
+        loads = [0] * len(batches)
+        for chain, counts in sorted(chains.items(), key=lambda item: -item[0][0] * item[0][1] * len(item[1])):
+            grid_size = chain[:2]
+            level = pipeline.pyramid_level(levels, grid_size)
+            grid = {'grid_size': grid_size, 'counts': counts}
+            grid.update(lab_payload(level, digest, ('pyramid',) + level.shape[:2], grid_size, color_space))
+            batch = loads.index(min(loads))
+            batches[batch].append(grid)
+            loads[batch] += grid_size[0] * grid_size[1] * len(counts)
+        
+        def finish(job, grid_results):
+            for grid, chain_results in zip(job.meta['grids'], grid_results):
+                for num_colors, result in zip(grid['counts'], chain_results):
+                    variant = tuple(grid['grid_size']) + (num_colors,)
+                    result_cache.put(keys[variant], result)
+                    results[variant] = result
+        
+        items = [({'grids': grids, 'algorithm': algorithm, 'color_space': color_space},
+                  {'grids': [{'grid_size': grid['grid_size'], 'counts': grid['counts']} for grid in grids]})
+                 for grids in batches]
+        try:
+            jobs = job_queue.submit_batch(items, VARIANT_STAGES, session_id=get_session_id(), on_done=finish)
+        except QueueFull:
+            response = jsonify({'error': 'The server is busy, please try again in a moment.'})
+            response.headers['Retry-After'] = '2'
+            return response, 429
+        if not job_queue.wait(jobs, VARIANT_TIMEOUT):
+            return jsonify({'error': 'Generating the variants took too long'}), 504
+        failed = [job for job in jobs if job.error is not None]
+        if failed:
+            return jsonify({'error': failed[0].error}), 500
+    
+    response = []
+    for v in variants:
+        result = results[v]
+        if 'thumbnail' not in result:
+            result['thumbnail'] = pipeline.thumbnail_png(result['pattern'])
+        vid = variant_id(keys[v])
+        variant_keys.put(vid, keys[v])
+        # Another worker may get the /use_variant request
+        pattern_store.put_variant(vid, result, keys[v])
+        response.append({
+            'id': vid,
+            'width': v[0],
+            'height': v[1],
+            'num_colors': v[2],
+            'thumbnail': 'data:image/png;base64,' + base64.b64encode(result['thumbnail']).decode('ascii'),
+            'cached': v in cached
+        })
+    return jsonify({
+        'variants': response,
+        'timings': {
+            'total': time.perf_counter() - started,
+            'jobs': [dict(job.meta, timings=job.to_dict()['timings']) for job in jobs]
+        }
+    })
+
+@app.route('/use_variant', methods=['POST'])
+def use_variant():
+    """Make a variant from /generate_variants the session's current pattern"""
+    data = request.get_json(silent=True) or {}
+    vid = str(data.get('id'))
+    key = variant_keys.get(vid)
+    result = result_cache.get(key) if key is not None else None
+    if result is None:
+        # Generated by another worker, or evicted here since
+        result, key = pattern_store.get_variant(vid) or (None, None)
+    # Spilled files with a missing or damaged key count as missing too
+    if result is None or not (isinstance(key, tuple) and len(key) == 8 and key[-1] == 'variant'):
+        return jsonify({'error': 'Unknown or expired variant, please generate it again'}), 404
+    session_id = get_session_id()
+    publish_result(session_id, result, key)
+    return jsonify({
+        'colors': result_colors(result['pattern']),
+        'width': key[1],
+        'height': key[2],
+        'num_colors': key[3],
+        'pattern_path': session_output_url(session_id, 'pattern.png')
+    })
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status, stage timings and (once done) the result of a /generate job"""
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
 @app.route('/update_color', methods=['POST'])
 def update_color():
-    global current_pattern, current_colors, current_indices
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern to update'}), 400
+    pattern = state['pattern']
     
     data = request.get_json()
     old_color = data.get('old_color')
     new_color = data.get('new_color')
     
-    # Find and update the color
-    for color in current_colors:
-        if color['rgb'] == old_color:
-            color['rgb'] = new_color
-            break
+    # Find and update the color; the RGB pattern follows from the palette
+    pattern.replace_color(old_color, new_color)
+    colors = pattern.colors
     
-    # Update the pattern array with new colors
-    height, width = current_indices.shape
-    for y in range(height):
-        for x in range(width):
-            color_idx = current_indices[y, x]
-            current_pattern[y, x] = current_colors[color_idx]['rgb']
+    # The preview is a palette image, so only its PLTE chunk needs replacing
+    preview = state.get('preview')
+    preview = renderer.recolor_png(preview, colors) if preview is not None else None
+    if preview is None:
+        preview = render_pattern_png(pattern.indices, colors)
+    state['preview'] = preview
+    pattern_store.put(session_id, state)
     
     # Update the pattern image
-    save_pattern_image(current_pattern, current_indices, current_colors)
+    with open(session_output_path(session_id, 'pattern.png'), 'wb') as f:
+        f.write(preview)
     
     return jsonify({
-        'colors': current_colors
+        'colors': colors,
+        'pattern_path': session_output_url(session_id, 'pattern.png')
+    })
+
+@app.route('/yarns')
+def list_yarns():
+    """Search the yarn catalog by name or brand"""
+    if yarn_catalog is None:
+        return jsonify({'error': 'No yarn catalog is configured'}), 404
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    found = yarn_catalog.search(request.args.get('q'), request.args.get('brand'), limit) if limit > 0 else []
+    return jsonify({'count': len(yarn_catalog), 'yarns': found})
+
+@app.route('/snap_yarns', methods=['POST'])
+def snap_yarns():
+    """Replace every pattern color with the nearest catalog yarn"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern to update'}), 400
+    data = request.get_json(silent=True) or {}
+    try:
+        selected = selected_yarns(data.get('yarns') or [])
+    except LookupError as e:
+        return jsonify({'error': e.args[0]}), 400
+    catalog = yarn_catalog if selected is yarn_catalog.yarns else yarns.YarnCatalog(selected)
+    
+    old = state['pattern']
+    pattern, matched = catalog.snap(old)
+    colors = result_colors(pattern, matched)
+    
+    # Unless colors were merged (and renumbered) only the preview's palette changes
+    preview = state.get('preview')
+    if preview is not None and pattern.num_colors == old.num_colors:
+        preview = renderer.recolor_png(preview, pattern.colors)
+    else:
+        preview = None
+    if preview is None:
+        preview = render_pattern_png(pattern.indices, pattern.colors)
+    state['pattern'] = pattern
+    state['preview'] = preview
+    pattern_store.put(session_id, state)
+    
+    with open(session_output_path(session_id, 'pattern.png'), 'wb') as f:
+        f.write(preview)
+    
+    return jsonify({
+        'colors': colors,
+        'merged': old.num_colors - pattern.num_colors,
+        'pattern_path': session_output_url(session_id, 'pattern.png')
+    })
+
+@app.route('/refine', methods=['POST'])
+def refine_pattern():
+    """Despeckle, even out runs or dither the generated pattern without re-quantizing"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern to refine'}), 400
+    
+    # Every refinement starts over from the pattern as generated
+    base = state.get('base')
+    if base is None:
+        return jsonify({'error': 'The generated pattern is no longer available, please generate it again'}), 409
+    pattern = state['pattern']
+    if pattern.num_colors != base.num_colors:
+        return jsonify({'error': 'Colors were merged since generating, please generate the pattern again'}), 409
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        dither = float(data.get('dither', 0))
+        majority = int(data.get('majority', 0))
+        iterations = int(data.get('iterations', 1))
+        min_run = int(data.get('min_run', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Refinement settings must be numbers'}), 400
+    if not 0 <= dither <= 2 or not 1 <= iterations <= 10 or min_run < 0:
+        return jsonify({'error': 'Refinement settings are out of range'}), 400
+    
+    # Edited colors are kept; only the stitches are reassigned
+    try:
+        indices, stats = refine.refine(base.indices, pattern.palette, state.get('image'),
+                                       dither, majority, iterations, min_run)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    pattern = Pattern(indices, pattern.palette, pattern.numbers)
+    state['pattern'] = pattern
+    state['preview'] = render_pattern_png(pattern.indices, pattern.colors)
+    pattern_store.put(session_id, state)
+    
+    with open(session_output_path(session_id, 'pattern.png'), 'wb') as f:
+        f.write(state['preview'])
+    
+    return jsonify({
+        'colors': pattern.colors,
+        'pattern_path': session_output_url(session_id, 'pattern.png'),
+        'refine': stats
     })
 
 @app.route('/clear', methods=['POST'])
 def clear():
-    global current_pattern, current_colors, current_indices
-    current_pattern = None
-    current_colors = []
-    current_indices = None
+    session_id = get_session_id()
+    pattern_store.delete(session_id)
     
     # Create an empty pattern image
     image = Image.new('RGB', (100, 100), 'white')
-    image.save('static/output/pattern.png')
+    image.save(session_output_path(session_id, 'pattern.png'))
     
     return jsonify({
         'success': True
@@ -247,263 +694,336 @@ def clear():
 
 # Clean up function to remove old files
 def cleanup_old_files():
-    """Remove old pattern and upload files."""
-    for directory in ['static/output', 'static/uploads']:
+    """Remove old pattern and upload files.
+
+    Output directories of sessions that still have a state (spilled by any
+    worker) are kept, since their pages still show those files.
+    """
+    for directory in [OUTPUT_ROOT, 'static/uploads']:
         for filename in os.listdir(directory):
             file_path = os.path.join(directory, filename)
             try:
                 if os.path.isfile(file_path):
                     os.unlink(file_path)
+                elif is_session_id(filename) and not pattern_store.has(filename):
+                    shutil.rmtree(file_path)
             except Exception as e:
                 print(f'Error deleting {file_path}: {e}')
 
+@app.cli.command('cleanup')
+def cleanup_command():
+    """Remove old pattern and upload files; run once before starting several workers."""
+    cleanup_old_files()
+
 @app.route('/toggle_numbers', methods=['POST'])
 def toggle_numbers():
     """Toggle the visibility of color numbers"""
     try:
         data = request.get_json()
         show_numbers = data.get('show_numbers', True)
-        if save_pattern_to_file(show_numbers):
-            return jsonify({'success': True})
+        session_id = get_session_id()
+        state = pattern_store.get(session_id)
+        layers = save_pattern_to_file(state, session_output_path(session_id, 'pattern.png'), show_numbers, session_id)
+        if layers:
+            state['show_numbers'] = show_numbers
+            pattern_store.put(session_id, state)
+            return jsonify({'success': True, 'pattern_path': session_output_url(session_id, 'pattern.png'),
+                            'render': layers.last})
         return jsonify({'success': False, 'error': 'No pattern to update'})
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'success': False, 'error': str(e)})
 
-# Call cleanup when starting the app
-cleanup_old_files()
+def save_pattern_to_file(state, output_path, show_numbers=True, session_id=None):
+    """Save a session's pattern as a full-size chart image.
 
-def save_pattern_to_file(show_numbers=True):
-    """Save the current pattern as an image"""
-    global current_pattern, current_colors, current_indices
-    if current_pattern is None:
+    Returns the ChartLayers used (which record what was rebuilt), or False
+    without a pattern.
+    """
+    if state is None:
         return False
     
-    # Create a new image with white background
-    scale = int(30)  # Increased from 20 to 30 pixels per bin
-    margin = int(100)  # Increased margin to accommodate larger pattern
-    bottom_margin = int(50)  # Reduced bottom margin since numbers are horizontal
-    pattern_width = int(current_pattern.shape[1] * scale)
-    pattern_height = int(current_pattern.shape[0] * scale)
-    img_width = int(pattern_width + 2 * margin)
-    img_height = int(pattern_height + margin + bottom_margin)
-    
-    img = Image.new('RGB', (img_width, img_height), 'white')
-    draw = ImageDraw.Draw(img)
-    
-    # Draw the pattern
-    for y in range(current_pattern.shape[0]):
-        for x in range(current_pattern.shape[1]):
-            color_idx = int(current_indices[y, x])
-            if color_idx < len(current_colors):
-                color = tuple(map(int, current_colors[color_idx]['rgb']))
-                # Draw rectangle with black outline
-                x1 = int(margin + x * scale)
-                y1 = int(margin + y * scale)
-                x2 = int(margin + (x + 1) * scale - 1)
-                y2 = int(margin + (y + 1) * scale - 1)
-                draw.rectangle([x1, y1, x2, y2], fill=color, outline='black')
-                
-                # Draw color number if enabled
-                if show_numbers:
-                    number = str(color_idx + 1)
-                    # Create a white background for the number
-                    font = ImageFont.truetype("arial.ttf", int(scale * 0.5))  # Increased font size
-                    text_bbox = draw.textbbox((0, 0), number, font=font)
-                    text_width = int(text_bbox[2] - text_bbox[0])
-                    text_height = int(text_bbox[3] - text_bbox[1])
-                    
-                    # Calculate text position
-                    text_x = int(margin + x * scale + (scale - text_width) // 2)
-                    text_y = int(margin + y * scale + (scale - text_height) // 2)
-                    
-                    # Draw white background
-                    padding = int(3)  # Increased padding
-                    bg_x1 = int(text_x - padding)
-                    bg_y1 = int(text_y - padding)
-                    bg_x2 = int(text_x + text_width + padding)
-                    bg_y2 = int(text_y + text_height + padding)
-                    draw.rectangle([bg_x1, bg_y1, bg_x2, bg_y2], fill='white')
-                    
-                    # Draw the number
-                    draw.text((text_x, text_y), number, fill='black', font=font)
-    
-    # Draw grid lines
-    for x in range(current_pattern.shape[1] + 1):
-        x_pos = int(margin + x * scale)
-        draw.line([x_pos, margin, x_pos, int(margin + pattern_height)], fill='black', width=2)  # Increased line width
-    for y in range(current_pattern.shape[0] + 1):
-        y_pos = int(margin + y * scale)
-        draw.line([margin, y_pos, int(margin + pattern_width), y_pos], fill='black', width=2)  # Increased line width
-    
-    # Draw border
-    border_width = int(3)  # Increased border width
-    draw.rectangle([
-        int(margin - border_width), int(margin - border_width),
-        int(margin + pattern_width + border_width), int(margin + pattern_height + border_width)
-    ], outline='black', width=border_width)
-    
-    # Draw y-axis numbers (starting from bottom)
-    font = ImageFont.truetype("arial.ttf", 16)  # Increased font size
-    for y in range(current_pattern.shape[0]):
-        # Calculate row number (starting from bottom)
-        row_number = current_pattern.shape[0] - y
-        number = str(row_number)
-        text_bbox = draw.textbbox((0, 0), number, font=font)
-        text_width = int(text_bbox[2] - text_bbox[0])
-        text_height = int(text_bbox[3] - text_bbox[1])
-        
-        text_x = int(margin + pattern_width + 15)  # Increased spacing
-        text_y = int(margin + y * scale + (scale - text_height) // 2)
-        draw.text((text_x, text_y), number, fill='black', font=font)
-    
-    # Draw x-axis numbers (starting from right)
-    for x in range(current_pattern.shape[1]):
-        # Calculate column number (starting from right)
-        col_number = current_pattern.shape[1] - x
-        number = str(col_number)
-        
-        # Get text dimensions
-        text_bbox = draw.textbbox((0, 0), number, font=font)
-        text_width = int(text_bbox[2] - text_bbox[0])
-        text_height = int(text_bbox[3] - text_bbox[1])
-        
-        # Draw tick mark
-        tick_x = int(margin + x * scale + scale // 2)
-        draw.line([
-            (tick_x, int(margin + pattern_height)),
-            (tick_x, int(margin + pattern_height + 5))
-        ], fill='black', width=2)
-        
-        # Draw number horizontally
-        text_x = int(margin + x * scale + (scale - text_width) // 2)
-        text_y = int(margin + pattern_height + 10)  # Small gap after tick mark
-        draw.text((text_x, text_y), number, fill='black', font=font)
+    # Only the layers whose inputs changed since the session's last chart are rebuilt
+    with chart_layers(session_id, state) as layers:
+        png = layers.png(show_numbers)
     
     # Save the pattern image
-    img.save('static/output/pattern.png')
-    return True
+    with open(output_path, 'wb') as f:
+        f.write(png)
+    return layers
 
-def save_color_list_image():
+def save_color_list_image(state, output_path):
     """Save the color list as an image"""
-    global current_colors
-    if not current_colors:
+    if state is None or not state['pattern'].num_colors:
         return False
-    
-    # Create a new image with white background
-    img_width = 400
-    img_height = 100 + len(current_colors) * 60
-    img = Image.new('RGB', (img_width, img_height), 'white')
-    draw = ImageDraw.Draw(img)
-    
-    # Draw title
-    draw.text((20, 20), "Color List", fill='black', font=ImageFont.truetype("arial.ttf", 24))
-    
-    # Draw each color
-    for i, color in enumerate(current_colors):
-        y = 80 + i * 60
-        # Draw color sample
-        draw.rectangle([20, y, 70, y + 50], fill=tuple(color['rgb']), outline='black')
-        # Draw color number and RGB values
-        text = f"Color {i + 1}: RGB({color['rgb'][0]}, {color['rgb'][1]}, {color['rgb'][2]})"
-        draw.text((90, y + 15), text, fill='black', font=ImageFont.truetype("arial.ttf", 16))
-    
-    # Save the color list image
-    img.save('static/output/color_list.png')
+    with open(output_path, 'wb') as f:
+        f.write(export_image(None, state, 'color_list'))
     return True
 
-def save_gauge_calculation_image():
+def save_gauge_calculation_image(state, output_path):
     """Save the gauge calculation as an image"""
-    global current_pattern
-    if current_pattern is None:
+    if state is None:
         return False
-    
-    # Create a new image with white background
-    img_width = 400
-    img_height = 300
-    img = Image.new('RGB', (img_width, img_height), 'white')
-    draw = ImageDraw.Draw(img)
-    
-    # Draw title
-    draw.text((20, 20), "Gauge Calculation", fill='black', font=ImageFont.truetype("arial.ttf", 24))
-    
-    # Draw gauge information
-    y = 80
-    draw.text((20, y), "Standard Gauge: 17 × 22", fill='black', font=ImageFont.truetype("arial.ttf", 16))
-    
-    y += 40
-    draw.text((20, y), f"Pattern Size: {current_pattern.shape[1]} × {current_pattern.shape[0]} stitches", 
-              fill='black', font=ImageFont.truetype("arial.ttf", 16))
-    
-    y += 40
-    # Calculate physical dimensions
-    physical_width = (current_pattern.shape[1] / 17) * 10
-    physical_height = (current_pattern.shape[0] / 22) * 10
-    draw.text((20, y), f"Estimated Size: {physical_width:.1f} × {physical_height:.1f} cm", 
-              fill='black', font=ImageFont.truetype("arial.ttf", 16))
-    
-    # Save the gauge calculation image
-    img.save('static/output/gauge_calculation.png')
+    with open(output_path, 'wb') as f:
+        f.write(export_image(None, state, 'gauge'))
     return True
 
 @app.route('/save_pattern', methods=['POST'])
 def save_pattern():
     """Save the pattern as an image"""
     try:
-        show_numbers = getattr(app, 'show_numbers', True)  # Get current show_numbers state
-        if save_pattern_to_file(show_numbers):
-            return jsonify({'success': True, 'message': 'Pattern saved successfully'})
+        session_id = get_session_id()
+        state = pattern_store.get(session_id)
+        show_numbers = state['show_numbers'] if state is not None else True
+        if save_pattern_to_file(state, session_output_path(session_id, 'pattern.png'), show_numbers, session_id):
+            return jsonify({'success': True, 'message': 'Pattern saved successfully',
+                            'path': session_output_url(session_id, 'pattern.png')})
         return jsonify({'success': False, 'error': 'No pattern to save'})
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/save_color_list', methods=['POST'])
 def save_color_list():
     """Save the color list as an image"""
     try:
-        if save_color_list_image():
-            return jsonify({'success': True, 'message': 'Color list saved successfully'})
+        session_id = get_session_id()
+        state = pattern_store.get(session_id)
+        if save_color_list_image(state, session_output_path(session_id, 'color_list.png')):
+            return jsonify({'success': True, 'message': 'Color list saved successfully',
+                            'path': session_output_url(session_id, 'color_list.png')})
         return jsonify({'success': False, 'error': 'No colors to save'})
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/save_gauge', methods=['POST'])
 def save_gauge():
     """Save the gauge calculation as an image"""
     try:
-        if save_gauge_calculation_image():
-            return jsonify({'success': True, 'message': 'Gauge calculation saved successfully'})
+        session_id = get_session_id()
+        state = pattern_store.get(session_id)
+        if save_gauge_calculation_image(state, session_output_path(session_id, 'gauge_calculation.png')):
+            return jsonify({'success': True, 'message': 'Gauge calculation saved successfully',
+                            'path': session_output_url(session_id, 'gauge_calculation.png')})
         return jsonify({'success': False, 'error': 'No pattern to calculate gauge for'})
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/save_all', methods=['POST'])
 def save_all():
     """Save all images (pattern, color list, and gauge calculation)"""
     try:
-        show_numbers = request.json.get('show_numbers', True) if request.json else True
+        show_numbers = request.json.get('show_numbers', True) if request.is_json and request.json else True
+        session_id = get_session_id()
+        state = pattern_store.get(session_id)
         
         # Try to save all files
-        pattern_saved = save_pattern_to_file(show_numbers)
-        colors_saved = save_color_list_image()
-        gauge_saved = save_gauge_calculation_image()
-        
+        pattern_saved = save_pattern_to_file(state, session_output_path(session_id, 'pattern.png'), show_numbers, session_id)
         if not pattern_saved:
             return jsonify({'success': False, 'error': 'No pattern to save'})
+        save_color_list_image(state, session_output_path(session_id, 'color_list.png'))
+        save_gauge_calculation_image(state, session_output_path(session_id, 'gauge_calculation.png'))
             
         return jsonify({
             'success': True,
             'message': 'All files saved successfully',
             'files': {
-                'pattern': 'static/output/pattern.png',
-                'color_list': 'static/output/color_list.png',
-                'gauge': 'static/output/gauge_calculation.png'
+                'pattern': session_output_url(session_id, 'pattern.png'),
+                'color_list': session_output_url(session_id, 'color_list.png'),
+                'gauge': session_output_url(session_id, 'gauge_calculation.png')
             }
         })
     except Exception as e:
+        metrics.record_error(request.endpoint, e)
         return jsonify({'success': False, 'error': str(e)})
 
-# Add show_numbers attribute to app
-app.show_numbers = True
+@app.route('/export/<item>')
+def export_file(item):
+    """Chart, color list or gauge of the current pattern as PNG or WebP, with an ETag"""
+    if item not in EXPORT_ITEMS:
+        abort(404)
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern'}), 404
+    image_format = request.args.get('format', 'png')
+    if image_format not in exports.FORMATS:
+        return jsonify({'error': f'Unknown format: {image_format}'}), 400
+    show_numbers = request_flag('show_numbers', state['show_numbers'])
+    
+    tag = exports.export_tag(exports.pattern_digest(state['pattern']), item, image_format,
+                             show_numbers if item == 'pattern' else None)
+    try:
+        return tagged_response(lambda: export_image(session_id, state, item, image_format, show_numbers),
+                               exports.FORMATS[image_format], tag,
+                               f'{EXPORT_ITEMS[item]}.{image_format}' if request.args.get('download') else None)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/export.zip')
+def export_zip():
+    """Chart, color list, gauge and instructions of the current pattern in one streamed ZIP"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern'}), 404
+    image_format = request.args.get('format', 'png')
+    if image_format not in exports.FORMATS:
+        return jsonify({'error': f'Unknown format: {image_format}'}), 400
+    show_numbers = request_flag('show_numbers', state['show_numbers'])
+    
+    # The archive is built from a copy, so later edits don't affect the stream
+    pattern = state['pattern'].copy()
+    snapshot = dict(state, pattern=pattern)
+    if image_format == 'webp':
+        with chart_layers(session_id, snapshot) as layers:
+            too_large = max(layers.canvas_size()) > exports.WEBP_MAX_SIZE
+        if too_large:
+            return jsonify({'error': 'The chart is too large for WebP, please use PNG'}), 400
+    
+    def entries():
+        for item, name in EXPORT_ITEMS.items():
+            yield f'{name}.{image_format}', export_image(session_id, snapshot, item, image_format, show_numbers), False
+        yield 'instructions.txt', instructions.iter_text(pattern, instructions.RowRuns(pattern.indices)), True
+    
+    tag = exports.export_tag(exports.pattern_digest(pattern), 'zip', image_format, show_numbers)
+    return tagged_response(lambda: stream_with_context(exports.zip_stream(entries())),
+                           'application/zip', tag, 'knitting_pattern.zip')
+
+@app.route('/export.pdf')
+def export_pdf():
+    """The current pattern's chart split into printable A4 pages, streamed as a PDF"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern'}), 404
+    try:
+        columns = int(request.args.get('columns', exports.PAGE_STITCHES[0]))
+        rows = int(request.args.get('rows', exports.PAGE_STITCHES[1]))
+    except ValueError:
+        return jsonify({'error': 'columns and rows must be numbers'}), 400
+    if not (5 <= columns <= 200 and 5 <= rows <= 200):
+        return jsonify({'error': 'columns and rows must be between 5 and 200 stitches'}), 400
+    show_numbers = request_flag('show_numbers', state['show_numbers'])
+    
+    # Own layers for a copy, so edits and other requests don't touch the pages being written
+    pattern = state['pattern'].copy()
+    layers = renderer.ChartLayers('chart')
+    layers.set_pattern(pattern.indices, pattern.colors)
+    
+    tag = exports.export_tag(exports.pattern_digest(pattern), 'pdf', columns, rows, show_numbers)
+    return tagged_response(lambda: stream_with_context(exports.pdf_stream(layers, show_numbers, (columns, rows))),
+                           'application/pdf', tag, 'knitting_pattern.pdf')
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit/miss/eviction counts and memory use of the result caches"""
+    return jsonify({
+        'images': image_cache.stats(),
+        'results': result_cache.stats(),
+        'layers': layer_cache.stats(),
+        'exports': export_cache.stats(),
+        'lab': lab_cache.stats(),
+        'sessions': pattern_store.stats(),
+        'jobs': job_queue.stats(),
+        'fonts': font_cache.stats()
+    })
+
+@app.route('/fonts/stats')
+def font_stats():
+    """Font and glyph cache hit rates"""
+    return jsonify(font_cache.stats())
+
+@app.route('/instructions')
+def knitting_instructions():
+    """Row-by-row instructions and stitch counts, streamed as text, CSV or JSON"""
+    state = pattern_store.get(get_session_id())
+    if state is None:
+        return jsonify({'error': 'No pattern'}), 404
+    output_format = request.args.get('format', 'text')
+    mode = request.args.get('mode', 'round')
+    if output_format not in instructions.FORMATS:
+        return jsonify({'error': f'Unknown format: {output_format}'}), 400
+    if mode not in instructions.MODES:
+        return jsonify({'error': f'Unknown mode: {mode}'}), 400
+    try:
+        cm_per_stitch = float(request.args['cm_per_stitch']) if 'cm_per_stitch' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'cm_per_stitch must be a number'}), 400
+    
+    # The runs are computed up front, so later edits don't affect the stream
+    pattern = state['pattern'].copy()
+    runs = instructions.RowRuns(pattern.indices, mode)
+    generate_lines, mimetype, extension = instructions.FORMATS[output_format]
+    response = Response(stream_with_context(generate_lines(pattern, runs, cm_per_stitch)), mimetype=mimetype)
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename=instructions.{extension}'
+    return response
+
+@app.route('/tiles/info')
+def tiles_info():
+    """Size of the session's chart and its tile grid at every zoom level"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        return jsonify({'error': 'No pattern'}), 404
+    with chart_layers(session_id, state) as layers:
+        height, width = layers.canvas_size()
+        grids = [layers.tile_grid(z) for z in range(renderer.MAX_ZOOM + 1)]
+    return jsonify({
+        'width': width,
+        'height': height,
+        'tile_size': renderer.TILE_SIZE,
+        'max_zoom': renderer.MAX_ZOOM,
+        'zooms': [{'zoom': z, 'columns': columns, 'rows': rows} for z, (columns, rows) in enumerate(grids)]
+    })
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def chart_tile(z, x, y):
+    """One tile of the session's chart, rendered on demand"""
+    session_id = get_session_id()
+    state = pattern_store.get(session_id)
+    if state is None:
+        abort(404)
+    with chart_layers(session_id, state) as layers:
+        image = layers.tile(z, x, y, state['show_numbers'])
+    if image is None:
+        abort(404)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    buffer.seek(0)
+    return send_file(buffer, mimetype='image/png')
+
+def cache_metrics():
+    caches = {'images': image_cache, 'results': result_cache, 'layers': layer_cache,
+              'exports': export_cache, 'lab': lab_cache}
+    return {name: cache.stats() for name, cache in caches.items()}
+
+metrics.REGISTRY.callback('gauge', 'knitting_cache_bytes', 'Bytes held by each cache.', ['cache'],
+                          lambda: {(name, ): stats['bytes'] for name, stats in cache_metrics().items()})
+metrics.REGISTRY.callback('counter', 'knitting_cache_hits_total', 'Cache hits.', ['cache'],
+                          lambda: {(name, ): stats['hits'] for name, stats in cache_metrics().items()})
+metrics.REGISTRY.callback('counter', 'knitting_cache_misses_total', 'Cache misses.', ['cache'],
+                          lambda: {(name, ): stats['misses'] for name, stats in cache_metrics().items()})
+metrics.REGISTRY.callback('gauge', 'knitting_sessions', 'Sessions held in memory.', [],
+                          lambda: {(): pattern_store.stats()['sessions']})
+metrics.REGISTRY.callback('gauge', 'knitting_jobs', 'Known jobs by status.', ['status'],
+                          lambda: {(status, ): count for status, count in job_queue.stats()['jobs'].items()})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage timings, request latencies, pattern sizes and cache use in the Prometheus text format"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/render/stats')
+def render_stats():
+    """Layer rebuild counts and timings of this session's chart"""
+    layers = layer_cache.get(get_session_id())
+    if layers is None:
+        return jsonify({'error': 'No chart rendered yet'}), 404
+    return jsonify(layers.stats())
 
 if __name__ == '__main__':
     # Clean up old files on startup
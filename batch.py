@@ -0,0 +1,218 @@
+"""Convert a folder of images into knitting patterns from the command line.
+
+Every input image is converted once per combination of grid size and color
+count. Each combination gets its own output folder with the chart
+(pattern.png), the color list (color_list.png and palette.json) and the
+gauge calculation (gauge_calculation.png). Images are spread over a process
+pool, and inputs whose content and settings match the manifest of an earlier
+run are skipped.
+
+Usage:
+    python batch.py test_images/ -o out/ --size 50x50 110x110 --colors 5 7
+    python batch.py "photos/*.jpg" -o out/ --algorithm median_cut --jobs 4
+    python batch.py test_images/ -o out/ --colorspace lab
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import quantize
+import renderer
+from cache import content_hash
+from colorspace import COLORSPACES
+from pipeline import decode_factor, decode_image, pattern_from_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+MANIFEST = 'manifest.json'
+STAGES = ('read', 'decode', 'quantize', 'chart', 'color_list', 'gauge')
+
+
+def find_images(inputs):
+    """Image files named by the inputs (files, directories or glob patterns)."""
+    paths = []
+    for spec in inputs:
+        if os.path.isdir(spec):
+            matches = [os.path.join(spec, name) for name in os.listdir(spec)]
+        else:
+            matches = glob.glob(spec)
+        paths += sorted(path for path in matches
+                        if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return list(dict.fromkeys(paths))
+
+
+def parse_size(text):
+    """'110x80' -> (110, 80); a single number means a square grid."""
+    try:
+        parts = [int(part) for part in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid grid size: {text}")
+    if len(parts) == 1:
+        parts *= 2
+    if len(parts) != 2 or min(parts) <= 0:
+        raise argparse.ArgumentTypeError(f"invalid grid size: {text}")
+    return tuple(parts)
+
+
+def setting_name(width, height, num_colors):
+    return f'{width}x{height}_{num_colors}colors'
+
+
+def convert_image(path, output_dir, settings, algorithm, color_space, show_numbers):
+    """Convert one image with every (width, height, num_colors) setting.
+
+    Runs in a worker process. Returns {stage: seconds} summed over settings.
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[stage] += time.perf_counter() - start
+        return result
+
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+
+    # One decode, reduced only as far as the largest grid allows
+    data = timed('read', read)
+    largest = (max(s[0] for s in settings), max(s[1] for s in settings))
+    image = timed('decode', lambda: decode_image(data, decode_factor(data, largest)))
+    for width, height, num_colors in settings:
+        directory = os.path.join(output_dir, setting_name(width, height, num_colors))
+        os.makedirs(directory, exist_ok=True)
+        _, indices, colors = timed('quantize', pattern_from_image,
+                                   image, (width, height), num_colors, algorithm, color_space)
+
+        def chart():
+            layers = renderer.ChartLayers('chart')
+            layers.set_pattern(indices, colors)
+            with open(os.path.join(directory, 'pattern.png'), 'wb') as f:
+                layers.write_png(f, show_numbers)
+
+        def color_list():
+            renderer.render_color_list(colors).save(os.path.join(directory, 'color_list.png'))
+            with open(os.path.join(directory, 'palette.json'), 'w') as f:
+                json.dump({'colors': colors, 'width': width, 'height': height}, f, indent=2)
+
+        timed('chart', chart)
+        timed('color_list', color_list)
+        timed('gauge', lambda: renderer.render_gauge(width, height).save(
+            os.path.join(directory, 'gauge_calculation.png')))
+    return timings
+
+
+def load_manifest(output_root):
+    try:
+        with open(os.path.join(output_root, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_root, manifest):
+    path = os.path.join(output_root, MANIFEST)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', default='batch_output', help='output directory')
+    parser.add_argument('--size', nargs='+', type=parse_size, default=[(110, 110)],
+                        help='grid sizes as WIDTHxHEIGHT (default: 110x110)')
+    parser.add_argument('--colors', nargs='+', type=int, default=[7], help='color counts (default: 7)')
+    parser.add_argument('--algorithm', default=quantize.DEFAULT_ALGORITHM, choices=sorted(quantize.BACKENDS))
+    parser.add_argument('--colorspace', default=quantize.DEFAULT_COLORSPACE, choices=COLORSPACES,
+                        help='color space to cluster in (default: rgb)')
+    parser.add_argument('--no-numbers', action='store_true', help='leave color numbers off the charts')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--force', action='store_true', help='convert inputs even if unchanged')
+    args = parser.parse_args(argv)
+
+    paths = find_images(args.inputs)
+    if not paths:
+        parser.error('no images found')
+    settings = [(width, height, k) for width, height in args.size for k in args.colors]
+    show_numbers = not args.no_numbers
+    os.makedirs(args.output, exist_ok=True)
+    manifest = load_manifest(args.output)
+
+    start = time.perf_counter()
+    timings = dict.fromkeys(STAGES, 0.0)
+    timings['hash'] = 0.0
+    pending = {}
+    skipped = 0
+    names = set()
+    for path in paths:
+        hash_start = time.perf_counter()
+        with open(path, 'rb') as f:
+            digest = content_hash(f.read())
+        timings['hash'] += time.perf_counter() - hash_start
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in names:
+            name = f'{name}-{digest[:8]}'
+        names.add(name)
+        output_dir = os.path.join(args.output, name)
+
+        # Only settings not already produced from this exact content
+        entry = manifest.get(name, {})
+        done = set(entry.get('settings', [])) if entry.get('hash') == digest else set()
+        options = [args.algorithm, show_numbers, args.colorspace]
+        if entry.get('options') != options:
+            done = set()
+        todo = [s for s in settings if args.force or setting_name(*s) not in done
+                or not os.path.exists(os.path.join(output_dir, setting_name(*s), 'pattern.png'))]
+        if not todo:
+            skipped += 1
+            continue
+        pending[path] = (name, digest, output_dir, todo, options, done)
+
+    converted = failed = patterns = 0
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = {executor.submit(convert_image, path, output_dir, todo, args.algorithm,
+                                   args.colorspace, show_numbers): path
+                   for path, (_, _, output_dir, todo, _, _) in pending.items()}
+        for future in as_completed(futures):
+            path = futures[future]
+            name, digest, _, todo, options, done = pending[path]
+            try:
+                image_timings = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{path}: failed: {e}', file=sys.stderr)
+                continue
+            for stage, seconds in image_timings.items():
+                timings[stage] += seconds
+            converted += 1
+            patterns += len(todo)
+            manifest[name] = {
+                'source': path,
+                'hash': digest,
+                'options': options,
+                'settings': sorted(done | {setting_name(*s) for s in todo}),
+            }
+            save_manifest(args.output, manifest)
+            print(f'{path}: {len(todo)} pattern(s) written to {os.path.join(args.output, name)}')
+
+    elapsed = time.perf_counter() - start
+    print()
+    print(f'{len(paths)} images: {converted} converted, {skipped} unchanged, {failed} failed '
+          f'in {elapsed:.2f} s with {args.jobs} worker(s)')
+    if converted:
+        print(f'{converted / elapsed:.2f} images/s, {patterns / elapsed:.2f} patterns/s')
+        print(f"{'stage':<12} {'total s':>9} {'ms/pattern':>11}")
+        for stage in ('hash',) + STAGES:
+            print(f'{stage:<12} {timings[stage]:>9.2f} {timings[stage] * 1000 / patterns:>11.1f}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Compare clustering in RGB and in CIELAB for wall time and perceptual error.
+
+Every image in test_images/ is resized to the grid and quantized by each
+backend in both color spaces. Error is the mean CIEDE2000 difference between
+each resized pixel and the palette color it was assigned. The Lab conversion
+cache is cleared before every Lab run, so its time includes the conversion.
+
+Usage:
+    python benchmarks/bench_colorspace.py [--size 110] [--colors 7] [--algorithms kmeans median_cut]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import colorspace  # noqa: E402
+import quantize  # noqa: E402
+from bench_quantize import load_resized  # noqa: E402
+
+
+def mean_delta_e_2000(original, quantized):
+    """Mean CIEDE2000 difference between two RGB images."""
+    return float(colorspace.delta_e_2000(colorspace.rgb_to_lab(original),
+                                         colorspace.rgb_to_lab(quantized)).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', nargs='+', default=sorted(glob.glob(os.path.join(ROOT, 'test_images', '*'))))
+    parser.add_argument('--size', type=int, default=110)
+    parser.add_argument('--colors', type=int, default=7)
+    parser.add_argument('--algorithms', nargs='+', default=list(quantize.BACKENDS))
+    args = parser.parse_args()
+
+    totals = {(name, space): [0.0, 0.0] for name in args.algorithms for space in colorspace.COLORSPACES}
+    print(f"{'image':<20} {'algorithm':<18} {'space':<5} {'ms':>8} {'dE2000':>7}")
+    for path in args.images:
+        image = load_resized(path, args.size)
+        for name in args.algorithms:
+            for space in colorspace.COLORSPACES:
+                colorspace.lab_cache.clear()
+                start = time.perf_counter()
+                pattern, _, _ = quantize.quantize_image(image, args.colors, name, space)
+                elapsed = time.perf_counter() - start
+                error = mean_delta_e_2000(image, pattern)
+                totals[name, space][0] += elapsed
+                totals[name, space][1] += error
+                print(f"{os.path.basename(path):<20} {name:<18} {space:<5} {elapsed * 1000:>8.1f} {error:>7.2f}")
+
+    print()
+    print(f"{'algorithm':<18} {'space':<5} {'total ms':>9} {'avg dE2000':>11}")
+    for (name, space), (elapsed, error) in totals.items():
+        print(f"{name:<18} {space:<5} {elapsed * 1000:>9.1f} {error / len(args.images):>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
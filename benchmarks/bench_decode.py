@@ -0,0 +1,81 @@
+"""Compare full-resolution and reduced decoding of uploads per image format.
+
+Every image in test_images/ is re-encoded in memory as JPEG, PNG and WebP.
+Each variant is then decoded and resized to the grid two ways: at full
+resolution (the old path) and at the reduced scale picked by
+pipeline.decode_factor. Decoded megapixels stand in for peak memory, since
+OpenCV's buffers are invisible to tracemalloc.
+
+Usage:
+    python benchmarks/bench_decode.py [--grid 110] [--repeat 3] [--images test_images/*.jpg]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from pipeline import decode_factor, decode_image  # noqa: E402
+
+FORMATS = {'jpg': '.jpg', 'png': '.png', 'webp': '.webp'}
+
+
+def best_of(func, repeat):
+    """Fastest of repeat runs, in milliseconds, and the last result."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def ingest(data, grid_size, reduce):
+    factor = decode_factor(data, grid_size) if reduce else 1
+    image = decode_image(data, factor)
+    return image, cv2.resize(image, grid_size, interpolation=cv2.INTER_AREA)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', nargs='+', default=sorted(glob.glob(os.path.join(ROOT, 'test_images', '*'))))
+    parser.add_argument('--grid', type=int, default=110)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    grid_size = (args.grid, args.grid)
+
+    totals = {name: [0.0, 0.0, 0.0, 0.0] for name in FORMATS}
+    print(f"{'image':<20} {'format':<6} {'full ms':>8} {'full MP':>8} {'reduced ms':>11} {'reduced MP':>11}")
+    for path in args.images:
+        source = cv2.imread(path)
+        if source is None:
+            continue
+        for name, extension in FORMATS.items():
+            ok, encoded = cv2.imencode(extension, source)
+            if not ok:
+                continue
+            data = encoded.tobytes()
+            full_ms, (full, _) = best_of(lambda: ingest(data, grid_size, False), args.repeat)
+            reduced_ms, (reduced, _) = best_of(lambda: ingest(data, grid_size, True), args.repeat)
+            full_mp = full.shape[0] * full.shape[1] / 1e6
+            reduced_mp = reduced.shape[0] * reduced.shape[1] / 1e6
+            for i, value in enumerate((full_ms, full_mp, reduced_ms, reduced_mp)):
+                totals[name][i] += value
+            print(f'{os.path.basename(path):<20} {name:<6} {full_ms:>8.1f} {full_mp:>8.2f} '
+                  f'{reduced_ms:>11.1f} {reduced_mp:>11.2f}')
+
+    print()
+    print(f"{'format':<6} {'full ms':>8} {'reduced ms':>11} {'speedup':>8} {'MP ratio':>9}")
+    for name, (full_ms, full_mp, reduced_ms, reduced_mp) in totals.items():
+        if reduced_ms:
+            print(f'{name:<6} {full_ms:>8.1f} {reduced_ms:>11.1f} {full_ms / reduced_ms:>7.2f}x '
+                  f'{full_mp / max(reduced_mp, 1e-9):>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Benchmark the /generate pipeline stage by stage and guard against regressions.
+
+Suite mode runs every stage for each image x grid size x color count:
+process_image, save_pattern_image, save_pattern_to_file (the full-size
+chart, built cold), save_color_list_image, and the /update_color and
+/toggle_numbers routes through the Flask test client. Time is the best of
+--repeat runs. Memory comes from one more run per stage: peak RSS (reset
+before each stage through /proc/self/clear_refs on Linux, otherwise the
+process high-water mark) and the tracemalloc peak, which includes NumPy
+buffers but not OpenCV's.
+
+Load mode (--load) instead sends requests from --concurrency threads, each
+with its own test client and session, and reports requests/s and latency
+percentiles per endpoint.
+
+--save writes the results as a JSON baseline; --baseline compares against
+one and exits with status 1 when a stage's time or allocations grow beyond
+--threshold (or a load endpoint's requests/s fall by as much).
+
+Importing app clears static/output like starting the server does, so do not
+run this next to a live instance in the same directory.
+
+Usage:
+    python benchmarks/bench_pipeline.py --sizes 10 50 100 200 400 --colors 2 7 20 --save baseline.json
+    python benchmarks/bench_pipeline.py --baseline baseline.json --threshold 0.25
+    python benchmarks/bench_pipeline.py --load update_color toggle_numbers --concurrency 8 --requests 400
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import app  # noqa: E402
+import pipeline  # noqa: E402
+from pattern import Pattern  # noqa: E402
+
+DEFAULT_IMAGES = ['pelo.png', 'flame.jpg', 'sunset1.webp']
+STAGES = ('process_image', 'save_pattern_image', 'save_pattern_to_file', 'save_color_list_image',
+          'update_color', 'toggle_numbers')
+LOAD_ENDPOINTS = ('update_color', 'toggle_numbers', 'instructions', 'tiles', 'generate')
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter; False where that is not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident memory in MB since the last reset (or process start)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def read(response):
+    """Consume and close a (possibly streamed) response in the calling thread."""
+    response.get_data()
+    response.close()
+    return response
+
+
+class Session:
+    """A test client with its own session holding a pattern."""
+
+    def __init__(self, pattern, preview):
+        self.client = app.app.test_client()
+        self.client.post('/clear')
+        self.id = self.client.get_cookie(app.SESSION_COOKIE).value
+        app.publish_result(self.id, {'pattern': pattern, 'png': preview})
+        self.original = pattern.palette[0].tolist()
+        self.edited = False
+        self.show_numbers = True
+
+    def update_color(self):
+        """Swap the first color back and forth so every call changes it."""
+        old, new = self.original, [255 - v for v in self.original]
+        if self.edited:
+            old, new = new, old
+        self.edited = not self.edited
+        return self.client.post('/update_color', json={'old_color': old, 'new_color': new})
+
+    def toggle_numbers(self):
+        self.show_numbers = not self.show_numbers
+        return self.client.post('/toggle_numbers', json={'show_numbers': self.show_numbers})
+
+    def instructions(self):
+        return read(self.client.get('/instructions?format=text'))
+
+    def tiles(self):
+        return read(self.client.get('/tiles/0/0/0.png'))
+
+    def close(self):
+        app.pattern_store.delete(self.id)
+        app.cleanup_session(self.id)
+
+
+def generate_request(client, path, size, num_colors):
+    """POST /generate and poll its job until done."""
+    with open(path, 'rb') as f:
+        response = client.post('/generate', data={
+            'image': (f, os.path.basename(path)), 'width': str(size), 'height': str(size),
+            'num_colors': str(num_colors)})
+    status = response.get_json()
+    while response.status_code == 202 and status.get('status') not in ('done', 'failed'):
+        time.sleep(0.01)
+        status = client.get(f"/jobs/{status['job_id']}").get_json()
+    return response
+
+
+def best_of(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_memory(func):
+    """(peak RSS MB, tracemalloc peak MB) of one call."""
+    reset_peak_rss()
+    tracemalloc.start()
+    try:
+        func()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak_rss_mb(), traced_peak / (1024 * 1024)
+
+
+def run_case(path, size, num_colors, repeat, directory):
+    """{stage: {'ms', 'rss_mb', 'alloc_mb'}} for one image and setting."""
+    grid_size = (size, size)
+    results = {}
+    outputs = {}
+
+    def process():
+        outputs['pattern'] = pipeline.process_image(path, grid_size, num_colors)
+
+    stages = {'process_image': process}
+    process()
+    _, indices, colors = outputs['pattern']
+    pattern = Pattern.from_colors(indices, colors)
+    state = {'pattern': pattern, 'show_numbers': True, 'preview': None}
+    stages['save_pattern_image'] = lambda: app.save_pattern_image(
+        None, indices, colors, os.path.join(directory, 'preview.png'))
+    stages['save_pattern_to_file'] = lambda: app.save_pattern_to_file(state, os.path.join(directory, 'chart.png'))
+    # Encoded color lists are cached by content, so the cache is cleared to time the encoding
+    stages['save_color_list_image'] = lambda: (
+        app.export_cache.clear(), app.save_color_list_image(state, os.path.join(directory, 'colors.png')))
+
+    session = Session(pattern, pipeline.render_pattern_png(indices, colors))
+    stages['update_color'] = session.update_color
+    stages['toggle_numbers'] = session.toggle_numbers
+    try:
+        for stage in STAGES:
+            seconds = best_of(stages[stage], repeat)
+            rss, alloc = measure_memory(stages[stage])
+            results[stage] = {'ms': round(seconds * 1000, 3), 'rss_mb': round(rss, 1), 'alloc_mb': round(alloc, 2)}
+    finally:
+        session.close()
+    return results
+
+
+def run_suite(args):
+    results = {}
+    print(f"{'case':<28} {'stage':<22} {'ms':>9} {'rss MB':>8} {'alloc MB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for path in args.images:
+            for size in args.sizes:
+                for num_colors in args.colors:
+                    case = f'{os.path.basename(path)}/{size}x{size}/{num_colors}'
+                    results[case] = run_case(path, size, num_colors, args.repeat, directory)
+                    for stage, result in results[case].items():
+                        print(f"{case:<28} {stage:<22} {result['ms']:>9.1f} {result['rss_mb']:>8.1f} "
+                              f"{result['alloc_mb']:>9.2f}")
+    return results
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+
+def run_load(args):
+    """{endpoint: {'rps', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'errors'}}."""
+    path = args.images[0]
+    _, indices, colors = pipeline.process_image(path, (args.load_size, args.load_size), args.load_colors)
+    pattern = Pattern.from_colors(indices, colors)
+    preview = pipeline.render_pattern_png(indices, colors)
+    results = {}
+    print(f"{'endpoint':<16} {'threads':>7} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'errors':>6}")
+    for endpoint in args.load:
+        sessions = [Session(pattern, preview) for _ in range(args.concurrency)]
+        latencies = []
+        errors = []
+        per_thread = max(args.requests // args.concurrency, 1)
+
+        def worker(session):
+            if endpoint == 'generate':
+                send = lambda: generate_request(session.client, path, args.load_size, args.load_colors)  # noqa: E731
+            else:
+                send = getattr(session, endpoint)
+            for _ in range(per_thread):
+                start = time.perf_counter()
+                response = send()
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+        threads = [threading.Thread(target=worker, args=(session,)) for session in sessions]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for session in sessions:
+            session.close()
+
+        result = {
+            'rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p90_ms': round(percentile(latencies, 90), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(max(latencies) * 1000, 2),
+            'errors': len(errors),
+        }
+        results[endpoint] = result
+        print(f"{endpoint:<16} {args.concurrency:>7} {len(latencies):>8} {result['rps']:>8.1f} "
+              f"{result['p50_ms']:>8.2f} {result['p90_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+              f"{result['max_ms']:>8.2f} {result['errors']:>6}")
+    return results
+
+
+def compare(current, baseline, threshold, min_ms, min_mb):
+    """Regressions of current against baseline as printable lines."""
+    regressions = []
+    for case, stages in current.get('suite', {}).items():
+        for stage, result in stages.items():
+            base = baseline.get('suite', {}).get(case, {}).get(stage)
+            if base is None:
+                continue
+            for field, floor in (('ms', min_ms), ('alloc_mb', min_mb)):
+                old, new = base[field], result[field]
+                if new > old * (1 + threshold) and new - old > floor:
+                    regressions.append(f'{case} {stage} {field}: {old} -> {new} (+{(new / old - 1) * 100:.0f}%)'
+                                       if old else f'{case} {stage} {field}: {old} -> {new}')
+    for endpoint, result in current.get('load', {}).items():
+        base = baseline.get('load', {}).get(endpoint)
+        if base is not None and result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append(f"load {endpoint} rps: {base['rps']} -> {result['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', nargs='+',
+                        default=[os.path.join(ROOT, 'test_images', name) for name in DEFAULT_IMAGES])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 200, 400])
+    parser.add_argument('--colors', type=int, nargs='+', default=[2, 7, 20])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--load', nargs='+', choices=LOAD_ENDPOINTS, help='run load mode for these endpoints')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint in load mode')
+    parser.add_argument('--load-size', type=int, default=110)
+    parser.add_argument('--load-colors', type=int, default=7)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression (default: 0.25)')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore time changes below this (default: 2)')
+    parser.add_argument('--min-mb', type=float, default=1.0, help='ignore allocation changes below this (default: 1)')
+    args = parser.parse_args()
+    args.images = [path for pattern in args.images for path in sorted(glob.glob(pattern))]
+    if not args.images:
+        parser.error('no images found')
+
+    results = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        }
+    }
+    if args.load:
+        results['load'] = run_load(args)
+    else:
+        results['suite'] = run_suite(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Results written to {args.save}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_ms, args.min_mb)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print(f'\nNo regressions beyond {args.threshold:.0%} against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
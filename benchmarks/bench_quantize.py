@@ -0,0 +1,72 @@
+"""Compare quantization backends on test_images/ for wall time and color error.
+
+Color error is the mean CIE76 Delta E between each resized pixel and the
+palette color it was assigned.
+
+Usage:
+    python benchmarks/bench_quantize.py [--size 110] [--colors 7] [--images test_images/*.jpg]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import quantize  # noqa: E402
+
+
+def load_resized(path, size):
+    """Decode an image as RGB and resize it to a size x size grid."""
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Could not load image: {path}")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+
+
+def to_lab(rgb):
+    """uint8 RGB array to float32 CIELAB."""
+    return cv2.cvtColor(rgb.astype(np.float32) / 255.0, cv2.COLOR_RGB2LAB)
+
+
+def mean_delta_e(original, quantized):
+    """Mean CIE76 Delta E between two RGB images."""
+    difference = to_lab(original) - to_lab(quantized)
+    return float(np.sqrt((difference ** 2).sum(axis=-1)).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', nargs='+', default=sorted(glob.glob(os.path.join(ROOT, 'test_images', '*'))))
+    parser.add_argument('--size', type=int, default=110)
+    parser.add_argument('--colors', type=int, default=7)
+    parser.add_argument('--algorithms', nargs='+', default=list(quantize.BACKENDS))
+    args = parser.parse_args()
+
+    totals = {name: [0.0, 0.0] for name in args.algorithms}
+    print(f"{'image':<20} {'algorithm':<18} {'ms':>8} {'mean dE':>8}")
+    for path in args.images:
+        image = load_resized(path, args.size)
+        for name in args.algorithms:
+            start = time.perf_counter()
+            pattern, _, _ = quantize.quantize_image(image, args.colors, name)
+            elapsed = time.perf_counter() - start
+            error = mean_delta_e(image, pattern)
+            totals[name][0] += elapsed
+            totals[name][1] += error
+            print(f"{os.path.basename(path):<20} {name:<18} {elapsed * 1000:>8.1f} {error:>8.2f}")
+
+    print()
+    print(f"{'algorithm':<18} {'total ms':>9} {'avg dE':>7}")
+    for name, (elapsed, error) in totals.items():
+        print(f"{name:<18} {elapsed * 1000:>9.1f} {error / len(args.images):>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Benchmark pattern rendering time against grid size.
+
+Usage:
+    python benchmarks/bench_render.py [--sizes 10 50 100 200] [--colors 7] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import renderer  # noqa: E402
+
+
+def random_pattern(size, num_colors, seed=0):
+    """Build a random square pattern with num_colors colors."""
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, num_colors, size=(size, size)).astype(np.int32)
+    colors = [{'number': i + 1, 'rgb': [int(c) for c in rng.integers(0, 256, 3)]}
+              for i in range(num_colors)]
+    return indices, colors
+
+
+def best_of(func, repeat):
+    """Best wall time of func() over repeat runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 25, 50, 100, 150, 200])
+    parser.add_argument('--colors', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'grid':>9} {'cells':>7} {'preview ms':>11} {'chart ms':>9} {'chart px':>11}")
+    for size in args.sizes:
+        indices, colors = random_pattern(size, args.colors)
+        preview = best_of(lambda: renderer.render_preview(indices, colors), args.repeat)
+        chart_image = renderer.render_chart(indices, colors)
+        chart = best_of(lambda: renderer.render_chart(indices, colors), args.repeat)
+        pixels = chart_image.size[0] * chart_image.size[1]
+        print(f"{size:>4}x{size:<4} {size * size:>7} {preview * 1000:>11.1f} {chart * 1000:>9.1f} {pixels:>11}")
+
+
+if __name__ == '__main__':
+    main()
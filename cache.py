@@ -0,0 +1,90 @@
+"""Bounded LRU caches with size-based eviction."""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def content_hash(data):
+    """Hex digest identifying a byte string by its content."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def sizeof(value):
+    """Approximate memory held by a cached value, in bytes."""
+    if hasattr(value, 'nbytes'):  # arrays and ChartLayers
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(v) for v in value.values()) + 64 * len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(sizeof(v) for v in value) + 8 * len(value)
+    return 64
+
+
+class LRUCache:
+    """Least-recently-used cache bounded by the total size of its values.
+
+    Entries larger than max_bytes are never stored. Safe to share between
+    request threads.
+    """
+
+    def __init__(self, max_bytes, name='cache'):
+        self.name = name
+        self.max_bytes = int(max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
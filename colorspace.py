@@ -0,0 +1,107 @@
+"""sRGB <-> CIELAB conversion and CIEDE2000 color difference.
+
+Conversions go through cv2.cvtColor on float32 data (D65 white point), so a
+whole image converts in one vectorized call. to_lab8 packs Lab into uint8
+channels so it can be quantized by the same backends as RGB: lightness is
+kept at its natural 0-100 scale and a/b are offset by 128, so Euclidean
+distances in the packed space stay CIE76 Delta E (to within rounding).
+to_lab8_cached remembers conversions by image content, so sweeping color
+counts or algorithms over the same resized image converts it only once.
+"""
+import cv2
+import numpy as np
+
+from cache import LRUCache, content_hash
+
+COLORSPACES = ('rgb', 'lab')
+
+lab_cache = LRUCache(64 * 1024 * 1024, 'lab')
+
+
+def rgb_to_lab(rgb):
+    """uint8 sRGB array (..., 3) to float32 CIELAB (L 0-100, a/b about -128-127)."""
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    flat = rgb.reshape(1, -1, 3).astype(np.float32) / 255.0
+    return cv2.cvtColor(flat, cv2.COLOR_RGB2LAB).reshape(rgb.shape)
+
+
+def lab_to_rgb(lab):
+    """Float CIELAB array (..., 3) to uint8 sRGB, clipped to the gamut."""
+    lab = np.asarray(lab, dtype=np.float32)
+    rgb = cv2.cvtColor(lab.reshape(1, -1, 3), cv2.COLOR_LAB2RGB).reshape(lab.shape)
+    return np.clip(np.round(rgb * 255.0), 0, 255).astype(np.uint8)
+
+
+def to_lab8(rgb):
+    """uint8 sRGB to packed uint8 Lab (L, a + 128, b + 128)."""
+    lab = rgb_to_lab(rgb)
+    lab[..., 1:] += 128.0
+    return np.clip(np.round(lab), 0, 255).astype(np.uint8)
+
+
+def from_lab8(lab8):
+    """Packed Lab (uint8 or float cluster centers) back to float CIELAB."""
+    lab = np.array(lab8, dtype=np.float32)
+    lab[..., 1:] -= 128.0
+    return lab
+
+
+def to_lab8_cached(rgb):
+    """to_lab8, remembered by the image's content."""
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+    key = (content_hash(rgb.tobytes()), rgb.shape)
+    lab8 = lab_cache.get(key)
+    if lab8 is None:
+        lab8 = to_lab8(rgb)
+        lab8.setflags(write=False)
+        lab_cache.put(key, lab8)
+    return lab8
+
+
+def delta_e_2000(lab1, lab2):
+    """CIEDE2000 difference between two broadcastable CIELAB arrays (..., 3)."""
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    C_mean7 = ((C1 + C2) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C_mean7 / (C_mean7 + 25.0 ** 7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, dhp)
+    dhp = np.where(dhp < -180, dhp + 360, dhp)
+    dhp = np.where(C1p * C2p == 0, 0.0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp / 2))
+
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    h_sum = h1p + h2p
+    hp_mean = np.where(np.abs(h1p - h2p) > 180,
+                       np.where(h_sum < 360, h_sum + 360, h_sum - 360), h_sum) / 2
+    hp_mean = np.where(C1p * C2p == 0, h_sum, hp_mean)
+
+    T = (1 - 0.17 * np.cos(np.radians(hp_mean - 30))
+         + 0.24 * np.cos(np.radians(2 * hp_mean))
+         + 0.32 * np.cos(np.radians(3 * hp_mean + 6))
+         - 0.20 * np.cos(np.radians(4 * hp_mean - 63)))
+    d_theta = 30 * np.exp(-(((hp_mean - 275) / 25) ** 2))
+    Cp_mean7 = Cp_mean ** 7
+    R_C = 2 * np.sqrt(Cp_mean7 / (Cp_mean7 + 25.0 ** 7))
+    S_L = 1 + 0.015 * (Lp_mean - 50) ** 2 / np.sqrt(20 + (Lp_mean - 50) ** 2)
+    S_C = 1 + 0.045 * Cp_mean
+    S_H = 1 + 0.015 * Cp_mean * T
+    R_T = -np.sin(np.radians(2 * d_theta)) * R_C
+
+    return np.sqrt((dLp / S_L) ** 2 + (dCp / S_C) ** 2 + (dHp / S_H) ** 2
+                   + R_T * (dCp / S_C) * (dHp / S_H))
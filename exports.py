@@ -0,0 +1,221 @@
+"""Encoding and packaging of downloads: images, ZIP archives and PDF charts.
+
+Exports are identified by content. export_tag hashes the pattern (indices,
+palette and numbers) together with the export's settings, so an unchanged
+pattern always gets the same tag, which serves both as cache key and as HTTP
+ETag. Images are saved as palette PNGs at the highest zlib level, or as
+lossless WebP. zip_stream and pdf_stream are generators that emit their file
+while it is being built: a download starts at once, and a PDF holds one
+page at a time however many pages the chart needs.
+"""
+import hashlib
+import io
+import zipfile
+import zlib
+
+import numpy as np
+from PIL import Image
+
+import metrics
+from quantize import unique_colors
+
+FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+PNG_COMPRESS_LEVEL = 9
+WEBP_MAX_SIZE = 16383  # the format's limit on either side, in pixels
+
+# A4 portrait, in points
+PAGE_SIZE = (595, 842)
+PAGE_MARGIN = 36
+CAPTION_HEIGHT = 20
+# Stitches (columns, rows) on each PDF page unless asked otherwise
+PAGE_STITCHES = (40, 50)
+
+# Fixed timestamp for archive entries, so the same content gives the same ZIP
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def pattern_digest(pattern):
+    """Hex digest of everything an export of pattern depends on."""
+    digest = hashlib.sha256(repr(pattern.shape).encode())
+    digest.update(np.ascontiguousarray(pattern.indices).tobytes())
+    digest.update(pattern.palette.tobytes())
+    digest.update(np.asarray(pattern.numbers).tobytes())
+    return digest.hexdigest()
+
+
+def export_tag(digest, *settings):
+    """Tag of one export of a pattern (see pattern_digest) with the given settings."""
+    return hashlib.sha256(f'{digest}:{settings!r}'.encode()).hexdigest()[:32]
+
+
+def palette_image(image):
+    """image in P mode if it is RGB with at most 256 colors, otherwise unchanged.
+
+    The conversion is exact, unlike Image.quantize.
+    """
+    if image.mode != 'RGB':
+        return image
+    pixels = np.asarray(image)
+    colors, inverse, _ = unique_colors(pixels.reshape(-1, 3))
+    if len(colors) > 256:
+        return image
+    converted = Image.fromarray(inverse.astype(np.uint8).reshape(pixels.shape[:2]), mode='P')
+    converted.putpalette(colors.tobytes())
+    return converted
+
+
+@metrics.timed('encode.export')
+def encode_image(image, image_format='png'):
+    """Encode a PIL image for download as a palette PNG or a lossless WebP."""
+    if image_format not in FORMATS:
+        raise ValueError(f"Unknown image format: {image_format}")
+    buffer = io.BytesIO()
+    if image_format == 'webp':
+        if max(image.size) > WEBP_MAX_SIZE:
+            raise ValueError(f"Images over {WEBP_MAX_SIZE} pixels across cannot be saved as WebP")
+        image.convert('RGB').save(buffer, format='WEBP', lossless=True)
+    else:
+        palette_image(image).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def chart_bytes(layers, show_numbers=True, image_format='png'):
+    """Encoded chart of a ChartLayers.
+
+    PNGs are streamed from the layers (band by band for huge charts) and
+    kept by them, so a color change only swaps the palette of the export.
+    """
+    if image_format == 'png':
+        return layers.png(show_numbers, PNG_COMPRESS_LEVEL)
+    height, width = layers.canvas_size()
+    if max(height, width) > WEBP_MAX_SIZE:
+        raise ValueError(f"Charts over {WEBP_MAX_SIZE} pixels across cannot be saved as WebP")
+    return encode_image(layers.image(show_numbers), image_format)
+
+
+class _Sink:
+    """Write-only file collecting what zipfile writes until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def zip_stream(entries):
+    """Yield a ZIP archive of entries as it is written.
+
+    entries yields (name, data, compress): data is bytes, or an iterable of
+    bytes or str chunks (such as the instructions generators). compress
+    deflates the entry; already compressed images are better stored.
+    """
+    sink = _Sink()
+    # zipfile falls back to data descriptors when the file cannot seek
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for name, data, compress in entries:
+            info = zipfile.ZipInfo(name, date_time=ZIP_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            with archive.open(info, 'w', force_zip64=True) as f:
+                for chunk in [data] if isinstance(data, (bytes, bytearray)) else data:
+                    f.write(chunk.encode() if isinstance(chunk, str) else chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def _pdf_string(text):
+    escaped = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return f'({escaped})'.encode('latin-1', 'replace')
+
+
+def pdf_stream(layers, show_numbers=True, stitches=PAGE_STITCHES, title='Knitting pattern'):
+    """Yield a PDF of the chart of a ChartLayers, split into printable pages.
+
+    Each page holds at most stitches (columns, rows) of the chart as a
+    Flate-compressed image, printed at the same scale on every page, with a
+    caption giving its rows and stitches numbered like the chart axes. Pages
+    are rendered and written one at a time; only the byte offsets of the
+    objects are kept for the cross-reference table at the end.
+    """
+    columns, rows = map(int, stitches)
+    if columns <= 0 or rows <= 0:
+        raise ValueError("Stitches per page must be positive")
+    pages = layers.page_grid(rows, columns)
+    height, width = layers.indices.shape
+    palette = layers.palette
+
+    # One scale for all pages, fitting the largest page into the printable area
+    page_width, page_height = PAGE_SIZE
+    area_width = page_width - 2 * PAGE_MARGIN
+    area_height = page_height - 2 * PAGE_MARGIN - CAPTION_HEIGHT
+    largest_width = max(right - left for (_, _, left, right), _ in pages)
+    largest_height = max(bottom - top for (top, bottom, _, _), _ in pages)
+    points = min(area_width / largest_width, area_height / largest_height)
+
+    offsets = {}
+    position = 0
+
+    def emit(number, body, stream=None):
+        nonlocal position
+        offsets[number] = position
+        data = f'{number} 0 obj\n'.encode() + body
+        if stream is not None:
+            data += b'\nstream\n' + stream + b'\nendstream'
+        data += b'\nendobj\n'
+        position += len(data)
+        return data
+
+    # Objects 1-3 are the catalog, page tree and font; each page then takes three
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position = len(header)
+    yield header
+    yield emit(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    yield emit(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+    if palette.dtype == np.uint8:
+        colorspace = (f'[/Indexed /DeviceRGB {palette.size - 1} <'.encode()
+                      + palette.rgb.tobytes().hex().encode() + b'>]')
+    else:
+        colorspace = b'/DeviceRGB'
+
+    kids = []
+    for number, (bounds, (row0, row1, col0, col1)) in enumerate(pages):
+        image_id, content_id, page_id = 4 + 3 * number, 5 + 3 * number, 6 + 3 * number
+        with metrics.span('export.pdf.page'):
+            codes = layers.page(bounds, show_numbers)
+            if palette.dtype != np.uint8:
+                codes = palette.rgb[codes]
+            image_height, image_width = codes.shape[:2]
+            data = zlib.compress(np.ascontiguousarray(codes).tobytes(), 6)
+            del codes
+        yield emit(image_id, (f'<< /Type /XObject /Subtype /Image /Width {image_width} /Height {image_height} '
+                              f'/BitsPerComponent 8 /Filter /FlateDecode /ColorSpace ').encode() + colorspace
+                   + f' /Length {len(data)} >>'.encode(), data)
+
+        # Rows count from the bottom of the chart and stitches from the right
+        caption = (f'{title} - page {number + 1} of {len(pages)}: rows {height - row1 + 1}-{height - row0}, '
+                   f'stitches {width - col1 + 1}-{width - col0}')
+        drawn_width, drawn_height = image_width * points, image_height * points
+        top = page_height - PAGE_MARGIN
+        content = (f'q {drawn_width:.2f} 0 0 {drawn_height:.2f} {PAGE_MARGIN} {top - drawn_height:.2f} cm '
+                   f'/Im0 Do Q\nBT /F1 9 Tf {PAGE_MARGIN} {PAGE_MARGIN} Td ').encode() + _pdf_string(caption) + b' Tj ET'
+        yield emit(content_id, f'<< /Length {len(content)} >>'.encode(), content)
+        yield emit(page_id, (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] '
+                             f'/Resources << /XObject << /Im0 {image_id} 0 R >> /Font << /F1 3 0 R >> >> '
+                             f'/Contents {content_id} 0 R >>').encode())
+        kids.append(f'{page_id} 0 R')
+
+    yield emit(2, f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'.encode())
+    count = max(offsets) + 1
+    xref = [f'xref\n0 {count}\n', '0000000000 65535 f \n']
+    xref.extend(f'{offsets[number]:010d} 00000 n \n' for number in range(1, count))
+    xref.append(f'trailer\n<< /Size {count} /Root 1 0 R >>\nstartxref\n{position}\n%%EOF\n')
+    yield ''.join(xref).encode()
@@ -0,0 +1,154 @@
+"""Shared font and glyph cache for all pattern renderers.
+
+Fonts are keyed by (face, size) and loaded once. Glyphs (alpha mask plus
+placement) and text bounding boxes are cached per (face, size, text), so the
+color numbers 1..N and axis labels 1..max_dim are rasterized only once per
+process instead of once per stitch.
+"""
+import logging
+import threading
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FACE = 'arial.ttf'
+
+# Tried in order when a face is missing (arial.ttf is usually absent on Linux)
+FALLBACK_FACES = (
+    'Arial.ttf',
+    'LiberationSans-Regular.ttf',
+    'DejaVuSans.ttf',
+    'FreeSans.ttf',
+)
+
+
+def rasterize_text(font, text):
+    """Rasterize text into an alpha mask.
+
+    Returns (alpha, offset_x, offset_y, bbox) where offset is the position of
+    the mask relative to the point passed to ImageDraw.text, and bbox is what
+    ImageDraw.textbbox would report for text drawn at (0, 0).
+    """
+    bbox = font.getbbox(text)
+    pad = 4
+    size = (int(bbox[2] - min(bbox[0], 0)) + 2 * pad, int(bbox[3] - min(bbox[1], 0)) + 2 * pad)
+    origin = (pad - min(bbox[0], 0), pad - min(bbox[1], 0))
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).text(origin, text, fill=255, font=font)
+    alpha = np.asarray(mask)
+    ys, xs = np.nonzero(alpha)
+    if len(ys) == 0:
+        return np.zeros((0, 0), dtype=np.uint8), 0, 0, bbox
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    return alpha[y0:y1, x0:x1].copy(), int(x0 - origin[0]), int(y0 - origin[1]), bbox
+
+
+class FontCache:
+    """Cache of fonts, text bounding boxes and rasterized glyphs."""
+
+    def __init__(self, face=DEFAULT_FACE, fallbacks=FALLBACK_FACES):
+        self.face = face
+        self.fallbacks = tuple(fallbacks)
+        self._lock = threading.Lock()
+        self._resolved = {}
+        self._fonts = {}
+        self._bboxes = {}
+        self._glyphs = {}
+        self._counters = {name: {'hits': 0, 'misses': 0} for name in ('fonts', 'bboxes', 'glyphs')}
+
+    def _count(self, name, hit):
+        self._counters[name]['hits' if hit else 'misses'] += 1
+
+    def _load(self, face, size):
+        """Load face at size, falling back to other faces and then PIL's default."""
+        resolved = self._resolved.get(face)
+        if resolved is not None:
+            return resolved(size)
+        for candidate in (face,) + tuple(f for f in self.fallbacks if f != face):
+            try:
+                font = ImageFont.truetype(candidate, size)
+            except OSError:
+                continue
+            if candidate != face:
+                logger.warning('Font %s not found, using %s', face, candidate)
+            self._resolved[face] = lambda s, c=candidate: ImageFont.truetype(c, s)
+            return font
+        logger.warning('Font %s not found, using the PIL default font', face)
+        self._resolved[face] = lambda s: ImageFont.load_default(s)
+        return ImageFont.load_default(size)
+
+    def font(self, size, face=None):
+        """Return the font for (face, size), loading it on first use."""
+        key = (face or self.face, int(size))
+        font = self._fonts.get(key)
+        self._count('fonts', font is not None)
+        if font is None:
+            with self._lock:
+                font = self._fonts.get(key)
+                if font is None:
+                    font = self._load(*key)
+                    self._fonts[key] = font
+        return font
+
+    def bbox(self, text, size, face=None):
+        """Bounding box of text drawn at (0, 0), as ImageDraw.textbbox reports it."""
+        key = (face or self.face, int(size), text)
+        bbox = self._bboxes.get(key)
+        self._count('bboxes', bbox is not None)
+        if bbox is None:
+            bbox = self.font(size, face).getbbox(text)
+            self._bboxes[key] = bbox
+        return bbox
+
+    def glyph(self, text, size, face=None):
+        """Rasterized text as (alpha, offset_x, offset_y, bbox); see rasterize_text."""
+        key = (face or self.face, int(size), text)
+        glyph = self._glyphs.get(key)
+        self._count('glyphs', glyph is not None)
+        if glyph is None:
+            glyph = rasterize_text(self.font(size, face), text)
+            glyph[0].setflags(write=False)
+            self._glyphs[key] = glyph
+            self._bboxes.setdefault(key, glyph[3])
+        return glyph
+
+    def preload(self, number_sizes=(), label_sizes=(), text_sizes=(), max_number=20, max_label=200):
+        """Load fonts and pre-render the color numbers and axis labels."""
+        for size in text_sizes:
+            self.font(size)
+        for size in number_sizes:
+            for number in range(1, max_number + 1):
+                self.glyph(str(number), size)
+        for size in label_sizes:
+            for number in range(1, max_label + 1):
+                self.glyph(str(number), size)
+
+    def stats(self):
+        """Hit/miss counters and hit rate per cache."""
+        stats = {}
+        for name, counter in self._counters.items():
+            total = counter['hits'] + counter['misses']
+            stats[name] = {
+                'hits': counter['hits'],
+                'misses': counter['misses'],
+                'hit_rate': counter['hits'] / total if total else 0.0,
+            }
+        stats['fonts']['entries'] = len(self._fonts)
+        stats['bboxes']['entries'] = len(self._bboxes)
+        stats['glyphs']['entries'] = len(self._glyphs)
+        stats['glyphs']['bytes'] = sum(g[0].nbytes for g in self._glyphs.values())
+        return stats
+
+    def clear(self):
+        """Drop every cached font and glyph."""
+        with self._lock:
+            self._resolved.clear()
+            self._fonts.clear()
+            self._bboxes.clear()
+            self._glyphs.clear()
+
+
+# Shared by every renderer in the process
+font_cache = FontCache()
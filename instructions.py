@@ -0,0 +1,145 @@
+"""Row-by-row knitting instructions and stitch statistics.
+
+Rows are numbered from the bottom of the chart and stitches from the right,
+matching the chart's axis labels. Worked in the round, every row is read
+right to left. Worked flat, even rows are wrong-side rows read left to
+right.
+
+The run-length encoding of every row is computed at once with NumPy. Only
+formatting the text, CSV or JSON output loops over rows, and it is done
+lazily by generators so responses can be streamed.
+"""
+import json
+
+import numpy as np
+
+MODES = ('round', 'flat')
+
+
+class RowRuns:
+    """Runs of same-colored stitches for every row of a pattern.
+
+    Row r (0 = bottom row) owns runs starts[r]:starts[r + 1] of values,
+    lengths and positions (the 1-based stitch where each run begins, in
+    working order).
+    """
+
+    def __init__(self, indices, mode='round'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.mode = mode
+        # Knitting order: bottom row first, each row starting from the right
+        rows = np.asarray(indices)[::-1, ::-1]
+        if mode == 'flat':
+            rows = rows.copy()
+            rows[1::2] = rows[1::2, ::-1]
+        height, width = rows.shape
+        self.height, self.width = height, width
+
+        # A run starts at the first stitch of a row and at every color change
+        starts = np.ones((height, width), dtype=bool)
+        starts[:, 1:] = rows[:, 1:] != rows[:, :-1]
+        run_rows, run_cols = np.nonzero(starts)
+        flat = run_rows * width + run_cols
+        self.values = rows[run_rows, run_cols]
+        self.lengths = np.diff(np.append(flat, height * width))
+        self.positions = run_cols + 1
+        runs_per_row = np.bincount(run_rows, minlength=height)
+        self.starts = np.concatenate(([0], np.cumsum(runs_per_row)))
+        # Color changes within each row, which drive float and bobbin planning
+        self.changes = runs_per_row - 1
+
+    def side(self, row):
+        """('RS' or 'WS', direction) of row (0 = bottom row)."""
+        if self.mode == 'flat' and row % 2 == 1:
+            return 'WS', 'left to right'
+        return 'RS', 'right to left'
+
+    def row(self, row):
+        """(values, lengths, positions) of the runs of one row."""
+        start, end = self.starts[row], self.starts[row + 1]
+        return self.values[start:end], self.lengths[start:end], self.positions[start:end]
+
+
+def stitch_counts(indices, num_colors):
+    """Number of stitches of each color."""
+    return np.bincount(np.asarray(indices).ravel(), minlength=num_colors)[:num_colors]
+
+
+def summary(pattern, runs, cm_per_stitch=None):
+    """Per-color totals and per-row change statistics as a dict."""
+    counts = stitch_counts(pattern.indices, pattern.num_colors)
+    total = int(counts.sum())
+    colors = []
+    for number, rgb, count in zip(pattern.numbers.tolist(), pattern.palette.tolist(), counts.tolist()):
+        entry = {'number': number, 'rgb': rgb, 'stitches': count,
+                 'percent': round(100 * count / total, 2) if total else 0.0}
+        if cm_per_stitch is not None:
+            entry['yarn_m'] = round(count * cm_per_stitch / 100, 2)
+        colors.append(entry)
+    return {
+        'width': runs.width,
+        'height': runs.height,
+        'mode': runs.mode,
+        'stitches': total,
+        'colors': colors,
+        'max_changes_per_row': int(runs.changes.max()) if runs.height else 0,
+        'mean_changes_per_row': round(float(runs.changes.mean()), 2) if runs.height else 0.0,
+    }
+
+
+def iter_text(pattern, runs, cm_per_stitch=None):
+    """Readable instructions, one line per row."""
+    numbers = pattern.numbers.tolist()
+    info = summary(pattern, runs, cm_per_stitch)
+    yield f"Pattern: {info['width']} stitches x {info['height']} rows, worked {runs.mode}\n"
+    for color in info['colors']:
+        line = f"C{color['number']} RGB{tuple(color['rgb'])}: {color['stitches']} stitches ({color['percent']}%)"
+        if 'yarn_m' in color:
+            line += f", about {color['yarn_m']} m"
+        yield line + '\n'
+    yield '\n'
+    for row in range(runs.height):
+        values, lengths, _ = runs.row(row)
+        side, direction = runs.side(row)
+        steps = ', '.join(f'{length}×C{numbers[value]}'
+                          for value, length in zip(values.tolist(), lengths.tolist()))
+        yield f'Row {row + 1} ({side}, {direction}): {steps} [{runs.changes[row]} changes]\n'
+
+
+def iter_csv(pattern, runs, cm_per_stitch=None):
+    """One CSV line per run: row, side, direction, first stitch, color, stitches."""
+    numbers = pattern.numbers.tolist()
+    yield 'row,side,direction,stitch,color,stitches\n'
+    for row in range(runs.height):
+        values, lengths, positions = runs.row(row)
+        side, direction = runs.side(row)
+        prefix = f'{row + 1},{side},{direction},'
+        yield ''.join(f'{prefix}{position},{numbers[value]},{length}\n'
+                      for value, length, position in zip(values.tolist(), lengths.tolist(), positions.tolist()))
+
+
+def iter_json(pattern, runs, cm_per_stitch=None):
+    """A JSON document with the summary and [color, stitches] runs per row."""
+    numbers = pattern.numbers.tolist()
+    head = json.dumps(summary(pattern, runs, cm_per_stitch))
+    yield head[:-1] + ', "rows": ['
+    for row in range(runs.height):
+        values, lengths, _ = runs.row(row)
+        side, direction = runs.side(row)
+        entry = json.dumps({
+            'row': row + 1,
+            'side': side,
+            'direction': direction,
+            'changes': int(runs.changes[row]),
+            'runs': [[numbers[value], length] for value, length in zip(values.tolist(), lengths.tolist())],
+        })
+        yield entry if row == 0 else ', ' + entry
+    yield ']}'
+
+
+FORMATS = {
+    'text': (iter_text, 'text/plain', 'txt'),
+    'csv': (iter_csv, 'text/csv', 'csv'),
+    'json': (iter_json, 'application/json', 'json'),
+}
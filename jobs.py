@@ -0,0 +1,265 @@
+"""Background job queue backed by a process pool.
+
+A job runs a list of named stages in worker processes, one after another,
+each stage receiving the previous stage's result. Jobs report their status
+(queued, the running stage's name, done or failed) with per-stage timings,
+and submit() refuses new jobs once too many are pending; submit_batch()
+takes several jobs at once, or none of them. When a worker process dies,
+the pool is replaced and the stages it took down are run once more.
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the pending job limit would be exceeded."""
+
+
+def _run_timed(func, arg):
+    # Spans recorded by the stage are sent back for the parent's metrics
+    with metrics.capture_spans() as spans:
+        start = time.perf_counter()
+        result = func(arg)
+        seconds = time.perf_counter() - start
+    return result, seconds, spans
+
+
+class Job:
+    def __init__(self, stages, session_id=None, meta=None, on_done=None):
+        self.id = uuid.uuid4().hex
+        self.stages = stages
+        self.session_id = session_id
+        self.meta = meta or {}
+        self.on_done = on_done
+        self.stage = 0
+        self.state = None  # None while running, then DONE or FAILED
+        self.error = None
+        self.result = None
+        self.timings = {}
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+        self.done = threading.Event()
+
+    @property
+    def status(self):
+        if self.state is not None:
+            return self.state
+        if self.stage == 0 and not (self.future is not None and self.future.running()):
+            return QUEUED
+        return self.stages[self.stage][0]
+
+    @property
+    def pending(self):
+        return self.state is None
+
+    def to_dict(self):
+        timings = dict(self.timings)
+        end = self.finished or time.time()
+        timings['total'] = end - self.created
+        # Whatever was not spent inside a stage was spent waiting for a worker
+        timings['queued'] = max(timings['total'] - sum(self.timings.values()), 0.0)
+        data = {'job_id': self.id, 'status': self.status, 'timings': timings}
+        if self.error is not None:
+            data['error'] = self.error
+        if self.result is not None:
+            data.update(self.result)
+        return data
+
+
+class JobQueue:
+    """Run job stages on a shared ProcessPoolExecutor.
+
+    max_pending bounds how many unfinished jobs may exist at once. With a
+    status_dir, job status is also written to disk so any worker process
+    sharing the directory can answer status requests.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, status_dir=None, ttl=600):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 4
+        self.status_dir = status_dir
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if status_dir:
+            os.makedirs(status_dir, exist_ok=True)
+
+    def executor(self):
+        # Created on first use so forking servers start the pool per worker;
+        # spawn keeps children clear of the parent's thread pools
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.pending)
+
+    def submit(self, payload, stages, session_id=None, meta=None, on_done=None):
+        """Queue a job running stages [(name, func), ...] on payload.
+
+        on_done(job, result) runs in this process after the last stage and
+        may set job.result to the dict merged into the job's status.
+        """
+        return self.submit_batch([(payload, meta)], stages, session_id, on_done)[0]
+
+    def submit_batch(self, items, stages, session_id=None, on_done=None):
+        """Queue one job per (payload, meta) in items, like submit.
+
+        Raises QueueFull without queueing any of them unless there is room
+        for all.
+        """
+        jobs = [Job(stages, session_id, meta, on_done) for _, meta in items]
+        with self._lock:
+            self._prune()
+            pending = sum(1 for j in self._jobs.values() if j.pending)
+            if pending + len(jobs) > self.max_pending:
+                raise QueueFull(f'{pending} of {self.max_pending} jobs already pending')
+            for job in jobs:
+                self._jobs[job.id] = job
+        for job, (payload, _) in zip(jobs, items):
+            self._start_stage(job, payload)
+        return jobs
+
+    def _drop_executor(self, executor):
+        """Forget a broken pool, so the next executor() call starts a new one."""
+        with self._lock:
+            if self._executor is not executor:
+                return  # already replaced for another job
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start_stage(self, job, arg, retried=False):
+        """Submit the job's current stage; a stage hit by a dead worker is retried once on a new pool."""
+        try:
+            executor = self.executor()
+            job.future = executor.submit(_run_timed, job.stages[job.stage][1], arg)
+        except BrokenProcessPool as e:
+            self._drop_executor(executor)
+            if retried:
+                self._finish(job, error=e)
+            else:
+                self._start_stage(job, arg, retried=True)
+            return
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        self._persist(job)
+        job.future.add_done_callback(lambda future: self._stage_done(job, future, executor, arg, retried))
+
+    def _stage_done(self, job, future, executor, arg, retried):
+        name = job.stages[job.stage][0]
+        try:
+            result, seconds, spans = future.result()
+        except BrokenProcessPool as e:
+            # A worker died (killed for memory, crashed); the pool is unusable from now on
+            metrics.record_error(f'job.{name}', e)
+            self._drop_executor(executor)
+            if retried:
+                self._finish(job, error=e)
+            else:
+                self._start_stage(job, arg, retried=True)
+            return
+        except Exception as e:
+            metrics.record_error(f'job.{name}', e)
+            self._finish(job, error=e)
+            return
+        job.timings[name] = seconds
+        metrics.observe_spans(spans)
+        metrics.record_span(f'job.{name}', seconds)
+        if job.stage + 1 < len(job.stages):
+            job.stage += 1
+            self._start_stage(job, result)
+            return
+        try:
+            if job.on_done is not None:
+                job.on_done(job, result)
+        except Exception as e:
+            metrics.record_error('job.on_done', e)
+            self._finish(job, error=e)
+            return
+        self._finish(job)
+
+    def _finish(self, job, error=None):
+        if error is not None:
+            job.error = str(error) or error.__class__.__name__
+        job.state = FAILED if error is not None else DONE
+        job.finished = time.time()
+        job.future = None
+        self._persist(job)
+        job.done.set()
+
+    def _status_path(self, job_id):
+        return os.path.join(self.status_dir, f'{job_id}.json')
+
+    def _persist(self, job):
+        if not self.status_dir:
+            return
+        path = self._status_path(job.id)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def wait(self, jobs, timeout=None):
+        """Block until all jobs have finished; False if timeout seconds passed first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in jobs:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not job.done.wait(remaining):
+                return False
+        return True
+
+    def status(self, job_id):
+        """Status dict of a job, or None if it is unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.status_dir and len(job_id) == 32 and job_id.isalnum():
+            try:
+                with open(self._status_path(job_id)) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return None
+        return None
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL (caller holds the lock)."""
+        deadline = time.time() - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < deadline]:
+            del self._jobs[job_id]
+            if self.status_dir:
+                try:
+                    os.unlink(self._status_path(job_id))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {'workers': self.max_workers, 'max_pending': self.max_pending, 'jobs': counts}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
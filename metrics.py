@@ -0,0 +1,280 @@
+"""In-process metrics: timing spans, histograms and counters.
+
+Everything lives in one Registry and is rendered in the Prometheus text
+exposition format for /metrics. Recording is a lock, a bisect and a few
+additions, so spans stay on in production.
+
+Spans recorded inside job worker processes would be lost with the worker's
+own registry, so jobs run their stages under capture_spans() and the
+captured (name, seconds) pairs are replayed here with observe_spans().
+
+RequestProfiler wraps one request in cProfile, or pyinstrument when it is
+installed and asked for; nothing is profiled unless a request opts in.
+"""
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import pyinstrument
+except ImportError:  # optional, cProfile is used without it
+    pyinstrument = None
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per combination of label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            if position < len(self.buckets):
+                entry[position] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return entry[-1] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(entry)) for key, entry in self._values.items())
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-2] + [entry[-1] - sum(entry[:-2])]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(entry[-2])}'
+            yield f'{self.name}_count{labels} {entry[-1]}'
+
+
+class CallbackMetric:
+    """Counter or gauge whose values are read from collect() when rendered.
+
+    collect returns {label values tuple: value}.
+    """
+
+    def __init__(self, kind, name, documentation, labelnames, collect):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def callback(self, kind, name, documentation, labelnames, collect):
+        metric = CallbackMetric(kind, name, documentation, labelnames, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.histogram(
+    'knitting_stage_seconds', 'Time spent in each decoding, quantizing and rendering stage.', ['stage'])
+request_seconds = REGISTRY.histogram(
+    'knitting_http_request_seconds', 'Request latency per route.', ['route', 'method', 'status'])
+errors = REGISTRY.counter(
+    'knitting_errors_total', 'Errors by where they happened and their type.', ['where', 'type'])
+pattern_cells = REGISTRY.histogram(
+    'knitting_pattern_cells', 'Stitches (width x height) of generated patterns.', [],
+    (100, 400, 1000, 2500, 5000, 10000, 20000, 40000, 100000, 250000, 1000000))
+pattern_colors = REGISTRY.histogram(
+    'knitting_pattern_colors', 'Colors of generated patterns.', [],
+    (2, 3, 4, 5, 6, 7, 8, 10, 12, 16, 20, 32, 64, 256))
+
+_local = threading.local()
+
+
+def record_span(name, seconds):
+    """Record an already measured stage duration."""
+    stage_seconds.observe(seconds, stage=name)
+    captured = getattr(_local, 'spans', None)
+    if captured is not None:
+        captured.append((name, seconds))
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator timing every call of a function as stage name."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_span(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def capture_spans():
+    """Collect the spans recorded by this thread in the enclosed block into a list."""
+    previous = getattr(_local, 'spans', None)
+    _local.spans = captured = []
+    try:
+        yield captured
+    finally:
+        _local.spans = previous
+
+
+def observe_spans(spans):
+    """Record spans captured in another process."""
+    for name, seconds in spans:
+        record_span(name, seconds)
+
+
+def record_error(where, error):
+    errors.inc(where=where, type=error.__class__.__name__ if isinstance(error, BaseException) else str(error))
+
+
+def record_pattern(shape, num_colors):
+    height, width = shape
+    pattern_cells.observe(height * width)
+    pattern_colors.observe(num_colors)
+
+
+class RequestProfiler:
+    """Profile one request with cProfile, or pyinstrument if asked and installed."""
+
+    def __init__(self, tool='cprofile'):
+        self.tool = 'pyinstrument' if tool == 'pyinstrument' and pyinstrument is not None else 'cprofile'
+        self.profiler = pyinstrument.Profiler() if self.tool == 'pyinstrument' else cProfile.Profile()
+
+    def start(self):
+        if self.tool == 'pyinstrument':
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.tool == 'pyinstrument':
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+
+    def dump(self, directory, name):
+        """Write the profile (.prof for pstats/snakeviz, .html for pyinstrument) and return its path."""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{id(self):x}')
+        if self.tool == 'pyinstrument':
+            path = f'{base}.html'
+            with open(path, 'w') as f:
+                f.write(self.profiler.output_html())
+        else:
+            path = f'{base}.prof'
+            self.profiler.dump_stats(path)
+        return path
+
+    def summary(self, limit=30):
+        """Top functions by cumulative time as text."""
+        if self.tool == 'pyinstrument':
+            return self.profiler.output_text()
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
@@ -0,0 +1,192 @@
+"""Compact pattern data model and its binary file format.
+
+A Pattern is a grid of palette indices (uint8, or uint16 above 256 colors)
+plus an (N, 3) uint8 palette and the number shown for each color. The RGB
+image is derived from them on demand instead of being stored alongside.
+
+The file format is a fixed 32-byte little-endian header followed by the
+palette, the color numbers, an optional JSON metadata block and the index
+grid, which starts 16-byte aligned. The grid is stored either raw, so it can
+be memory-mapped straight from the file, or run-length encoded as a values
+array followed by a uint32 run lengths array.
+
+    offset  size  field
+    0       4     magic b'KPAT'
+    4       1     format version (1)
+    5       1     flags (1 = run-length encoded grid)
+    6       1     bytes per index (1 or 2)
+    8       2     number of colors N
+    12      4     grid height
+    16      4     grid width
+    20      4     number of runs (RLE only)
+    24      4     metadata length in bytes
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'KPAT'
+VERSION = 1
+FLAG_RLE = 1
+HEADER = struct.Struct('<4sBBBxH2xIIII4x')
+ALIGNMENT = 16
+
+
+def index_dtype(num_colors):
+    """Smallest little-endian unsigned dtype holding indices below num_colors."""
+    return np.dtype('u1') if num_colors <= 256 else np.dtype('<u2')
+
+
+class Pattern:
+    """Palette-indexed knitting pattern."""
+
+    __slots__ = ('indices', 'palette', 'numbers', '_rgb')
+
+    def __init__(self, indices, palette, numbers=None):
+        self.palette = np.array(palette, dtype=np.uint8).reshape(-1, 3)
+        dtype = index_dtype(len(self.palette))
+        indices = np.asarray(indices)
+        if indices.dtype != dtype:
+            indices = indices.astype(dtype)
+        # Indices never change after creation, so copies can share them
+        self.indices = indices.view()
+        self.indices.setflags(write=False)
+        if numbers is None:
+            numbers = np.arange(1, len(self.palette) + 1)
+        self.numbers = np.array(numbers, dtype='<u2')
+        self._rgb = None
+
+    @classmethod
+    def from_colors(cls, indices, colors):
+        """Build from an index grid and a list of {'number', 'rgb'} dicts."""
+        return cls(indices, [color['rgb'] for color in colors], [color['number'] for color in colors])
+
+    @property
+    def colors(self):
+        """The palette as a list of {'number', 'rgb'} dicts."""
+        return [{'number': int(number), 'rgb': [int(v) for v in rgb]}
+                for number, rgb in zip(self.numbers, self.palette)]
+
+    @property
+    def num_colors(self):
+        return len(self.palette)
+
+    @property
+    def shape(self):
+        return self.indices.shape
+
+    @property
+    def rgb(self):
+        """(height, width, 3) uint8 image, built on first use."""
+        if self._rgb is None:
+            self._rgb = self.palette[self.indices]
+            self._rgb.setflags(write=False)
+        return self._rgb
+
+    @property
+    def nbytes(self):
+        total = self.indices.nbytes + self.palette.nbytes + self.numbers.nbytes
+        return total + (self._rgb.nbytes if self._rgb is not None else 0)
+
+    def set_color(self, index, rgb):
+        self.palette[index] = rgb
+        self._rgb = None
+
+    def replace_color(self, old_rgb, new_rgb):
+        """Change the first palette entry equal to old_rgb; False if none is."""
+        try:
+            index = self.palette.tolist().index(list(old_rgb))
+        except (TypeError, ValueError):
+            return False
+        self.set_color(index, new_rgb)
+        return True
+
+    def copy(self):
+        """Copy with its own palette, sharing the (read-only) indices."""
+        return Pattern(self.indices, self.palette, self.numbers)
+
+    def save(self, file, rle=None, meta=None):
+        save_pattern(file, self, rle, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        return load_pattern(path, mmap)[0]
+
+
+def run_lengths(values):
+    """(run values, run lengths) of a 1-D array."""
+    if len(values) == 0:
+        return values[:0], np.zeros(0, dtype='<u4')
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    return values[starts], lengths.astype('<u4')
+
+
+def _padding(position, alignment=ALIGNMENT):
+    return -position % alignment
+
+
+def save_pattern(file, pattern, rle=None, meta=None):
+    """Write pattern to a binary file object.
+
+    rle=None run-length encodes the grid only when that is smaller. meta is
+    an optional JSON-serializable dict stored with it.
+    """
+    indices = np.ascontiguousarray(pattern.indices)
+    flat = indices.reshape(-1)
+    values, lengths = run_lengths(flat) if rle is not False else (None, None)
+    if rle is None:
+        rle = len(values) * (indices.itemsize + 4) < flat.nbytes
+    meta_bytes = json.dumps(meta).encode() if meta is not None else b''
+    height, width = indices.shape
+    file.write(HEADER.pack(MAGIC, VERSION, FLAG_RLE if rle else 0, indices.itemsize,
+                           pattern.num_colors, height, width, len(values) if rle else 0, len(meta_bytes)))
+    file.write(pattern.palette.tobytes())
+    file.write(pattern.numbers.tobytes())
+    file.write(meta_bytes)
+    position = HEADER.size + pattern.num_colors * 5 + len(meta_bytes)
+    file.write(b'\0' * _padding(position))
+    if not rle:
+        file.write(indices.tobytes())
+        return
+    file.write(values.tobytes())
+    file.write(b'\0' * _padding(values.nbytes, 4))
+    file.write(lengths.tobytes())
+
+
+def load_pattern(path, mmap=True):
+    """Read a pattern file, returning (pattern, meta).
+
+    With mmap, a raw index grid is memory-mapped from the file rather than
+    read; run-length encoded grids are always expanded into memory.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"Not a pattern file: {path}")
+        magic, version, flags, itemsize, num_colors, height, width, runs, meta_length = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a pattern file: {path}")
+        palette = np.frombuffer(f.read(num_colors * 3), dtype=np.uint8).reshape(-1, 3)
+        numbers = np.frombuffer(f.read(num_colors * 2), dtype='<u2')
+        meta = json.loads(f.read(meta_length)) if meta_length else None
+    offset = HEADER.size + num_colors * 5 + meta_length
+    offset += _padding(offset)
+    dtype = np.dtype('u1') if itemsize == 1 else np.dtype('<u2')
+
+    def read(count, dtype, offset):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        if mmap:
+            return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        return np.fromfile(path, dtype=dtype, count=count, offset=offset)
+
+    if flags & FLAG_RLE:
+        values = read(runs, dtype, offset)
+        offset += runs * itemsize
+        lengths = read(runs, np.dtype('<u4'), offset + _padding(offset, 4))
+        indices = np.repeat(values, lengths).reshape(height, width)
+    else:
+        indices = read(height * width, dtype, offset).reshape(height, width)
+    return Pattern(indices, palette, numbers), meta
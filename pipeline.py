@@ -0,0 +1,236 @@
+"""Image-to-pattern pipeline: decode, resize, quantize and render.
+
+Kept free of Flask and module-level side effects so the same functions can
+run in the request thread or in worker processes.
+"""
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metrics
+import quantize
+import renderer
+from pattern import Pattern
+from yarns import YarnCatalog
+
+# OpenCV flags decoding at 1/factor of the full resolution. Only JPEGs are
+# scaled inside the decoder (libjpeg DCT scaling); other formats are decoded
+# in full and then shrunk, which is slower than decoding alone, so they are
+# never reduced.
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# Longest side of variant thumbnails, in pixels
+THUMBNAIL_SIZE = 160
+
+
+def reducible_size(source):
+    """(width, height) of an encoded JPEG as it will be decoded, or None.
+
+    Only the header is read. source is a path or a binary file object. Other
+    formats give None since reduced decoding does not pay off for them.
+    """
+    try:
+        with Image.open(source) as image:
+            if image.format != 'JPEG':
+                return None
+            width, height = image.size
+            # EXIF orientations 5-8 rotate by 90 degrees when decoded
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                width, height = height, width
+    except Exception:
+        return None
+    return width, height
+
+
+def reduction_factor(size, grid_size):
+    """Largest decode reduction (1, 2, 4 or 8) still covering grid_size pixels."""
+    if size is None or grid_size is None:
+        return 1
+    width, height = size
+    grid_width, grid_height = map(int, grid_size)
+    for factor in (8, 4, 2):
+        if width // factor >= grid_width and height // factor >= grid_height:
+            return factor
+    return 1
+
+
+def decode_factor(data, grid_size):
+    """reduction_factor for uploaded image bytes."""
+    return reduction_factor(reducible_size(io.BytesIO(data)), grid_size)
+
+
+@metrics.timed('decode')
+def load_image(image_path, grid_size=None):
+    """Load an image file as an RGB array, reduced as far as grid_size allows."""
+    factor = reduction_factor(reducible_size(image_path), grid_size)
+    image = cv2.imread(image_path, REDUCED_FLAGS[factor])
+    if image is None:
+        raise ValueError(f"Could not load image: {image_path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+@metrics.timed('decode')
+def decode_image(data, factor=1):
+    """Decode uploaded image bytes into an RGB array at 1/factor resolution.
+
+    Decoding straight from memory avoids writing the upload to disk first;
+    pick factor with decode_factor so the result still covers the grid.
+    """
+    if not data:
+        raise ValueError("Uploaded image is empty")
+    try:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), REDUCED_FLAGS[factor])
+    except cv2.error:
+        image = None
+    if image is None:
+        raise ValueError("Could not decode uploaded image")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def resize_to_grid(image, grid_size):
+    """Resize an RGB image to one pixel per stitch."""
+    # Convert grid_size to integers and ensure positive values
+    width, height = map(int, grid_size)
+    if width <= 0 or height <= 0:
+        raise ValueError("Width and height must be positive numbers")
+
+    if image.shape[:2] == (height, width):
+        return image
+
+    # Resize the image
+    grid_size = (width, height)  # Already integers from map(int, grid_size)
+    with metrics.span('resize'):
+        return cv2.resize(image, grid_size, interpolation=cv2.INTER_AREA)
+
+
+def build_pyramid(image, min_size):
+    """The image and its successive halvings that still cover min_size (width, height).
+
+    Halving with INTER_AREA averages 2x2 blocks, so each level is as good a
+    starting point for a grid resize as the full image, and much cheaper.
+    """
+    min_width, min_height = map(int, min_size)
+    levels = [image]
+    with metrics.span('pyramid'):
+        while True:
+            height, width = levels[-1].shape[:2]
+            if width // 2 < min_width or height // 2 < min_height:
+                break
+            level = cv2.resize(levels[-1], (width // 2, height // 2), interpolation=cv2.INTER_AREA)
+            level.setflags(write=False)
+            levels.append(level)
+    return levels
+
+
+def pyramid_level(levels, grid_size):
+    """The smallest pyramid level still covering grid_size."""
+    width, height = map(int, grid_size)
+    for level in reversed(levels):
+        if level.shape[1] >= width and level.shape[0] >= height:
+            return level
+    return levels[0]
+
+
+def pattern_from_image(image, grid_size, num_colors, algorithm=quantize.DEFAULT_ALGORITHM,
+                       color_space=quantize.DEFAULT_COLORSPACE, yarns=None, init_colors=None, lab8=None):
+    """Resize an RGB image to the grid and reduce its colors.
+
+    Given a YarnCatalog as yarns, every cell takes the nearest of its yarns
+    instead, and num_colors, algorithm and color_space are not used.
+    init_colors and lab8 are passed on to quantize.quantize_image; lab8
+    must then be of the image already resized to the grid.
+    """
+    resized_image = resize_to_grid(image, grid_size)
+
+    if yarns is not None:
+        with metrics.span('quantize.yarns'):
+            return yarns.quantize_image(resized_image)
+
+    # Color clustering with the selected backend
+    with metrics.span(f'quantize.{algorithm}'):
+        return quantize.quantize_image(resized_image, num_colors, algorithm, color_space, init_colors, lab8)
+
+
+def process_image(image_path, grid_size, num_colors, algorithm=quantize.DEFAULT_ALGORITHM,
+                  color_space=quantize.DEFAULT_COLORSPACE):
+    """Process input image to create knitting pattern."""
+    return pattern_from_image(load_image(image_path, grid_size), grid_size, num_colors, algorithm, color_space)
+
+
+def render_pattern_png(pattern_indices, colors, scale=20, show_numbers=True):
+    """Render the pattern preview and encode it as PNG bytes."""
+    image = renderer.render_preview(pattern_indices, colors, scale=int(scale), show_numbers=show_numbers)
+    with metrics.span('encode.preview'):
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def quantize_stage(payload):
+    """Job stage: quantize payload['image'] with the payload's settings.
+
+    payload['yarns'] is an optional list of catalog yarns to quantize against;
+    the result then has the matched yarn of each color under 'yarns'. The
+    resized image is kept as 'image' for later refinement (see refine.py).
+    An optional payload['lab'] holds the image's packed Lab pixels, already
+    resized to the grid, so Lab requests skip the conversion.
+    """
+    catalog = YarnCatalog(payload['yarns']) if payload['yarns'] else None
+    image = resize_to_grid(payload['image'], payload['grid_size'])
+    image.setflags(write=False)
+    _, indices, colors = pattern_from_image(
+        image, payload['grid_size'], payload['num_colors'], payload['algorithm'],
+        payload['color_space'], catalog, lab8=payload.get('lab'))
+    result = {'pattern': Pattern.from_colors(indices, colors), 'image': image}
+    if catalog is not None:
+        result['yarns'] = [color['yarn'] for color in colors]
+    return result
+
+
+def thumbnail_png(pattern, size=THUMBNAIL_SIZE):
+    """Small PNG of a pattern's colors, one block of pixels per stitch."""
+    height, width = pattern.shape
+    scale = size / max(width, height)
+    thumbnail_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    with metrics.span('encode.thumbnail'):
+        image = Image.fromarray(pattern.rgb).resize(thumbnail_size, Image.NEAREST)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def variants_stage(payload):
+    """Job stage: quantize images to grids at several color counts each.
+
+    payload['grids'] lists dicts with the 'image', its 'grid_size' and the
+    'counts' to run, and optionally 'lab' as for quantize_stage; the
+    algorithm and color space are shared. Each image is resized once for
+    all its counts. Counts run in the given order, each warm-started from
+    the colors of the one before it, so pass them sorted. Returns, per
+    grid, a list of quantize_stage-like results, each with its 'thumbnail'
+    PNG.
+    """
+    grid_results = []
+    for grid in payload['grids']:
+        image = resize_to_grid(grid['image'], grid['grid_size'])
+        image.setflags(write=False)
+        results = []
+        colors = None
+        for num_colors in grid['counts']:
+            _, indices, colors = pattern_from_image(
+                image, grid['grid_size'], num_colors, payload['algorithm'], payload['color_space'],
+                init_colors=colors, lab8=grid.get('lab'))
+            pattern = Pattern.from_colors(indices, colors)
+            results.append({'pattern': pattern, 'image': image, 'thumbnail': thumbnail_png(pattern)})
+        grid_results.append(results)
+    return grid_results
+
+
+def render_stage(result):
+    """Job stage: add the preview PNG to a quantize_stage result."""
+    pattern = result['pattern']
+    result['png'] = render_pattern_png(pattern.indices, pattern.colors)
+    return result
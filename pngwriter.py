@@ -0,0 +1,49 @@
+"""Streaming PNG encoder.
+
+write_png takes the image as an iterable of row bands and compresses each
+band as it arrives, so only one band has to exist in memory at a time no
+matter how large the image is.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_chunk(chunk_type, data):
+    """Encode one PNG chunk (length, type, data, CRC)."""
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def write_png(file, width, height, bands, palette=None, compress_level=6):
+    """Write a PNG to the binary file object file.
+
+    bands yields uint8 arrays of shape (rows, width) holding palette indices
+    when palette (an (N, 3) uint8 array, N <= 256) is given, or
+    (rows, width, 3) RGB otherwise, top to bottom and height rows in total.
+    """
+    color_type = 3 if palette is not None else 2
+    file.write(PNG_SIGNATURE)
+    file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+    if palette is not None:
+        file.write(png_chunk(b'PLTE', np.asarray(palette, dtype=np.uint8).tobytes()))
+
+    compressor = zlib.compressobj(compress_level)
+    rows_written = 0
+    for band in bands:
+        band = np.ascontiguousarray(band, dtype=np.uint8)
+        rows = band.reshape(band.shape[0], -1)
+        # Every scanline starts with its filter type (0, no filtering)
+        scanlines = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 1:] = rows
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            file.write(png_chunk(b'IDAT', data))
+        rows_written += rows.shape[0]
+    if rows_written != height:
+        raise ValueError(f"Expected {height} rows, got {rows_written}")
+    file.write(png_chunk(b'IDAT', compressor.flush()))
+    file.write(png_chunk(b'IEND', b''))
@@ -0,0 +1,297 @@
+"""Color quantization backends.
+
+Each backend takes an (N, 3) uint8 RGB pixel array and a color count and
+returns (centers, labels): an (K, 3) float array of palette colors and an
+(N,) array assigning every pixel to a center. quantize_image wraps any of
+them into the (pattern, pattern_indices, colors) contract of process_image.
+
+With color_space='lab', quantize_image clusters the image in CIELAB instead
+(packed into uint8 by colorspace.to_lab8, so every backend works unchanged)
+and converts the centers back to sRGB.
+
+The KMeans backends can also be warm-started from the palette of a nearby
+color count (see seed_centers), which /generate_variants uses when trying
+several color counts on one image.
+"""
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+import colorspace
+
+DEFAULT_ALGORITHM = 'kmeans'
+DEFAULT_COLORSPACE = 'rgb'
+
+
+def unique_colors(pixels):
+    """Deduplicate pixels into (colors, inverse, counts)."""
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    keys = (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    colors = np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], axis=1).astype(np.uint8)
+    return colors, inverse.ravel(), counts
+
+
+def _weighted_means(colors, counts, groups, num_groups):
+    """Count-weighted mean color of each group."""
+    totals = np.zeros((num_groups, 3), dtype=np.float64)
+    np.add.at(totals, groups, colors.astype(np.float64) * counts[:, None])
+    weights = np.bincount(groups, weights=counts, minlength=num_groups)
+    return totals / weights[:, None]
+
+
+def kmeans(pixels, num_colors, init=None):
+    """Full KMeans on every pixel (the original behaviour).
+
+    Given init centers, a single run starts from them instead of ten
+    k-means++ restarts.
+    """
+    if init is None:
+        model = KMeans(n_clusters=num_colors, random_state=42, n_init=10)
+    else:
+        model = KMeans(n_clusters=num_colors, init=init, random_state=42, n_init=1)
+    model.fit(pixels)
+    return model.cluster_centers_, model.labels_
+
+
+def minibatch_kmeans(pixels, num_colors):
+    """MiniBatchKMeans; much cheaper than KMeans on large grids."""
+    model = MiniBatchKMeans(n_clusters=num_colors, random_state=42, n_init=3, batch_size=2048)
+    model.fit(pixels)
+    return model.cluster_centers_, model.labels_
+
+
+def histogram_kmeans(pixels, num_colors, init=None):
+    """KMeans (k-means++) on the unique colors, weighted by how often they occur."""
+    colors, inverse, counts = unique_colors(pixels)
+    num_colors = min(num_colors, len(colors))
+    if init is None:
+        model = KMeans(n_clusters=num_colors, init='k-means++', random_state=42, n_init=10)
+    else:
+        model = KMeans(n_clusters=num_colors, init=init[:num_colors], random_state=42, n_init=1)
+    model.fit(colors.astype(np.float64), sample_weight=counts)
+    return model.cluster_centers_, model.labels_[inverse]
+
+
+def median_cut(pixels, num_colors):
+    """Median cut over the color histogram.
+
+    Repeatedly splits the box with the widest channel range at its weighted
+    median until there are num_colors boxes.
+    """
+    colors, inverse, counts = unique_colors(pixels)
+    boxes = np.zeros(len(colors), dtype=np.intp)
+    num_boxes = 1
+    while num_boxes < num_colors:
+        # Widest channel range of every box
+        lows = np.full((num_boxes, 3), 255, dtype=np.int32)
+        highs = np.zeros((num_boxes, 3), dtype=np.int32)
+        np.minimum.at(lows, boxes, colors)
+        np.maximum.at(highs, boxes, colors)
+        ranges = highs - lows
+        box = int(np.argmax(ranges.max(axis=1)))
+        if ranges[box].max() == 0:
+            break  # every box is a single color
+        channel = int(np.argmax(ranges[box]))
+
+        # Split at the count-weighted median along that channel
+        members = np.nonzero(boxes == box)[0]
+        order = members[np.argsort(colors[members, channel], kind='stable')]
+        values = colors[order, channel]
+        cumulative = np.cumsum(counts[order])
+        median = values[np.searchsorted(cumulative, cumulative[-1] / 2)]
+        # Equal values stay on one side; both halves are non-empty since range > 0
+        upper = values >= median if median == values[-1] else values > median
+        boxes[order[upper]] = num_boxes
+        num_boxes += 1
+
+    centers = _weighted_means(colors, counts, boxes, num_boxes)
+    return centers, boxes[inverse]
+
+
+def _octree_codes(colors, depth):
+    """Octree node code of each color at the given depth (0..8)."""
+    shift = 8 - depth
+    r = colors[:, 0].astype(np.int64) >> shift
+    g = colors[:, 1].astype(np.int64) >> shift
+    b = colors[:, 2].astype(np.int64) >> shift
+    return (r << (2 * depth)) | (g << depth) | b
+
+
+def _octree_codes_per_depth(colors, depths):
+    """Octree node code of each color at its own depth."""
+    codes = np.zeros(len(colors), dtype=np.int64)
+    for depth in np.unique(depths):
+        selected = depths == depth
+        codes[selected] = _octree_codes(colors[selected], int(depth))
+    return codes
+
+
+def octree(pixels, num_colors, max_depth=6):
+    """Octree quantizer.
+
+    Colors start in leaves at max_depth; leaves are folded into their parents,
+    least populated parents first, until about num_colors leaves remain. Each
+    level is reduced with array operations rather than per-node loops.
+    """
+    colors, inverse, counts = unique_colors(pixels)
+    depths = np.full(len(colors), max_depth, dtype=np.int64)
+
+    def leaf_ids():
+        keys = (depths << 32) | _octree_codes_per_depth(colors, depths)
+        _, ids = np.unique(keys, return_inverse=True)
+        return ids.ravel()
+
+    while True:
+        ids = leaf_ids()
+        num_leaves = int(ids.max()) + 1
+        depth = int(depths.max())
+        if num_leaves <= num_colors or depth == 0:
+            break
+        at_depth = np.nonzero(depths == depth)[0]
+
+        # Group the deepest leaves under their parents
+        parents = _octree_codes(colors[at_depth], depth - 1)
+        parent_keys, parent_of = np.unique(parents, return_inverse=True)
+        parent_of = parent_of.ravel()
+        leaf_pairs = np.unique(np.stack([parent_of, ids[at_depth]], axis=1), axis=0)
+        children = np.bincount(leaf_pairs[:, 0], minlength=len(parent_keys))
+        weight = np.bincount(parent_of, weights=counts[at_depth], minlength=len(parent_keys))
+
+        # Folding a parent turns its children into one leaf
+        gains = children - 1
+        if num_leaves - gains.sum() >= num_colors:
+            depths[at_depth] = depth - 1
+            continue
+        # Fold the lightest parents without dropping below num_colors
+        order = np.argsort(weight, kind='stable')
+        needed = num_leaves - num_colors
+        count = int(np.searchsorted(np.cumsum(gains[order]), needed, side='right'))
+        fold = np.zeros(len(parent_keys), dtype=bool)
+        fold[order[:count]] = True
+        depths[at_depth[fold[parent_of]]] = depth - 1
+        ids = leaf_ids()
+        break
+
+    num_leaves = int(ids.max()) + 1
+    centers = _weighted_means(colors, counts, ids, num_leaves)
+    weights = np.bincount(ids, weights=counts, minlength=num_leaves)
+
+    # Folding whole parents can overshoot, so merge the closest leftover leaves
+    while len(centers) > num_colors:
+        distances = ((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        np.fill_diagonal(distances, np.inf)
+        a, b = sorted(np.unravel_index(int(np.argmin(distances)), distances.shape))
+        total = weights[a] + weights[b]
+        centers[a] = (centers[a] * weights[a] + centers[b] * weights[b]) / total
+        weights[a] = total
+        centers = np.delete(centers, b, axis=0)
+        weights = np.delete(weights, b)
+        ids = np.where(ids == b, a, ids)
+        ids = np.where(ids > b, ids - 1, ids)
+    return centers, ids[inverse]
+
+
+def _nearest_centers(pixels, centers):
+    """(index of the nearest center, squared distance to it) for each pixel."""
+    distances = (pixels ** 2).sum(axis=1)[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)
+    nearest = distances.argmin(axis=1)
+    return nearest, np.maximum(distances[np.arange(len(pixels)), nearest], 0)
+
+
+def seed_centers(pixels, previous, num_colors):
+    """Initial centers for num_colors clusters from a nearby count's centers.
+
+    Surplus previous centers are dropped, least populated first. Missing
+    ones come from splitting the cluster with the largest squared error in
+    two along its principal axis, one split at a time.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    centers = np.asarray(previous, dtype=np.float64).reshape(-1, 3)
+    if len(centers) > num_colors:
+        nearest, _ = _nearest_centers(pixels, centers)
+        populations = np.bincount(nearest, minlength=len(centers))
+        centers = centers[np.sort(np.argsort(-populations, kind='stable')[:num_colors])]
+    while len(centers) < num_colors:
+        nearest, distances = _nearest_centers(pixels, centers)
+        worst = int(np.argmax(np.bincount(nearest, weights=distances, minlength=len(centers))))
+        members = pixels[nearest == worst]
+        offsets = members - members.mean(axis=0)
+        axis = np.linalg.svd(offsets, full_matrices=False)[2][0]
+        side = offsets @ axis > 0
+        if side.all() or not side.any():
+            break  # nothing left to split (fewer distinct colors than asked for)
+        halves = [members[~side].mean(axis=0), members[side].mean(axis=0)]
+        centers = np.vstack([np.delete(centers, worst, axis=0), halves])
+    return centers
+
+
+BACKENDS = {
+    'kmeans': kmeans,
+    'minibatch': minibatch_kmeans,
+    'median_cut': median_cut,
+    'octree': octree,
+    'histogram_kmeans': histogram_kmeans,
+}
+
+
+# Backends that can start from given centers (see seed_centers). A single
+# run from good seeds replaces ten k-means++ restarts, about 4x faster;
+# MiniBatchKMeans is cheap enough already that seeding it does not pay off.
+WARM_STARTS = {'kmeans', 'histogram_kmeans'}
+
+
+def quantize(pixels, num_colors, algorithm=DEFAULT_ALGORITHM, init=None):
+    """Run the named backend on an (N, 3) pixel array.
+
+    init is an optional (K, 3) array of centers found for a nearby color
+    count; backends in WARM_STARTS start from them, the others ignore it.
+    """
+    if algorithm not in BACKENDS:
+        raise ValueError(f"Unknown quantization algorithm: {algorithm}")
+    if init is not None and algorithm in WARM_STARTS:
+        seeds = seed_centers(pixels, init, int(num_colors))
+        centers, labels = BACKENDS[algorithm](pixels, len(seeds), seeds)
+    else:
+        centers, labels = BACKENDS[algorithm](pixels, int(num_colors))
+    return np.asarray(centers, dtype=np.float64), np.asarray(labels)
+
+
+def quantize_image(image, num_colors, algorithm=DEFAULT_ALGORITHM, color_space=DEFAULT_COLORSPACE,
+                   init_colors=None, lab8=None):
+    """Quantize an (H, W, 3) RGB image into (pattern, pattern_indices, colors).
+
+    init_colors, the colors list of an earlier result for the same image,
+    warm-starts the clustering (see quantize). lab8, the image already
+    converted with colorspace.to_lab8, saves converting it again for Lab.
+    """
+    if color_space not in colorspace.COLORSPACES:
+        raise ValueError(f"Unknown color space: {color_space}")
+    height, width = image.shape[:2]
+    init = None
+    if init_colors is not None:
+        init = np.array([color['rgb'] for color in init_colors], dtype=np.uint8)
+    if color_space == 'lab':
+        if lab8 is None:
+            lab8 = colorspace.to_lab8_cached(image)
+        pixels = lab8.reshape((-1, 3))
+        if init is not None:
+            init = colorspace.to_lab8(init)
+        centers, labels = quantize(pixels, num_colors, algorithm, init)
+        centers = colorspace.lab_to_rgb(colorspace.from_lab8(centers)).astype(np.float64)
+    else:
+        pixels = image.reshape((-1, 3))
+        centers, labels = quantize(pixels, num_colors, algorithm, init)
+
+    # Create pattern grid with color indices
+    pattern_indices = labels.reshape(height, width).astype(np.int32)
+    pattern = centers[labels].reshape(image.shape).astype(np.uint8)
+
+    # Generate color mapping
+    colors = []
+    for i, center in enumerate(centers):
+        colors.append({
+            'number': i + 1,
+            'rgb': [int(x) for x in center]
+        })
+
+    return pattern, pattern_indices, colors
@@ -0,0 +1,170 @@
+"""Clean-up of quantized patterns: despeckling, short runs and dithering.
+
+Each step maps a grid of palette indices to a new one and is vectorized:
+the majority filter loops over palette colors (one OpenCV box filter each),
+never over stitches, and the run-length step works on the run encoding of
+all rows at once. refine applies the requested steps in a fixed order:
+dithering (which re-maps the resized source image, so it needs one), then
+the majority filter, then the minimum run length.
+"""
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+
+MAX_FILTER_SIZE = 15
+BAYER_SIZE = 4
+
+
+def isolated_stitches(indices):
+    """Number of stitches whose four neighbors all have other colors."""
+    padded = np.pad(indices, 1, mode='edge')
+    center = padded[1:-1, 1:-1]
+    same = ((padded[:-2, 1:-1] == center) | (padded[2:, 1:-1] == center)
+            | (padded[1:-1, :-2] == center) | (padded[1:-1, 2:] == center))
+    return int(np.count_nonzero(~same))
+
+
+def majority_filter(indices, num_colors, size=3, iterations=1):
+    """Give each stitch the most common color of its size x size window.
+
+    A stitch only changes when another color strictly outnumbers its own,
+    so ties keep the original color.
+    """
+    if size % 2 == 0 or not 3 <= size <= MAX_FILTER_SIZE:
+        raise ValueError(f"Filter size must be odd and between 3 and {MAX_FILTER_SIZE}")
+    labels = np.asarray(indices)
+    for _ in range(iterations):
+        own_count = np.zeros(labels.shape, dtype=np.uint8)
+        best_count = np.zeros(labels.shape, dtype=np.uint8)
+        best_label = labels.copy()
+        for label in np.unique(labels):
+            mask = (labels == label).view(np.uint8)
+            # Unnormalized box filter: how many stitches of this color are in each window
+            count = cv2.boxFilter(mask, -1, (size, size), normalize=False, borderType=cv2.BORDER_REPLICATE)
+            np.copyto(own_count, count, where=mask.view(bool))
+            better = count > best_count
+            best_count[better] = count[better]
+            best_label[better] = label
+        changed = best_count > own_count
+        if not changed.any():
+            break
+        labels = np.where(changed, best_label, labels)
+    return labels
+
+
+def enforce_min_run(indices, min_run):
+    """Recolor runs shorter than min_run stitches within each row.
+
+    A short run takes the color of the longer of the nearest runs of at
+    least min_run stitches to its left and right in the same row. Rows
+    without any such run are left as they are.
+    """
+    labels = np.asarray(indices)
+    height, width = labels.shape
+    if min_run <= 1 or labels.size == 0:
+        return labels
+
+    # Run encoding of all rows at once (runs never cross a row boundary)
+    starts = np.ones((height, width), dtype=bool)
+    starts[:, 1:] = labels[:, 1:] != labels[:, :-1]
+    run_rows, run_cols = np.nonzero(starts)
+    flat = run_rows * width + run_cols
+    values = labels[run_rows, run_cols]
+    lengths = np.diff(np.append(flat, labels.size))
+    long_runs = lengths >= min_run
+    if long_runs.all():
+        return labels
+
+    # Nearest long run on each side, found by filling run numbers forward and backward
+    positions = np.arange(len(values))
+    left = np.maximum.accumulate(np.where(long_runs, positions, -1))
+    right = np.minimum.accumulate(np.where(long_runs, positions, len(values))[::-1])[::-1]
+    left_ok = (left >= 0) & (run_rows[np.maximum(left, 0)] == run_rows)
+    right_ok = (right < len(values)) & (run_rows[np.minimum(right, len(values) - 1)] == run_rows)
+    left_length = np.where(left_ok, lengths[np.maximum(left, 0)], 0)
+    right_length = np.where(right_ok, lengths[np.minimum(right, len(values) - 1)], 0)
+    source = np.where(right_length > left_length, right, left)
+
+    replace = ~long_runs & (left_ok | right_ok)
+    values = np.where(replace, values[np.clip(source, 0, len(values) - 1)], values)
+    return np.repeat(values, lengths).reshape(height, width)
+
+
+def bayer_matrix(size=BAYER_SIZE):
+    """size x size ordered dithering thresholds in (0, 1); size a power of two."""
+    matrix = np.zeros((1, 1))
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size
+
+
+def palette_spacing(palette):
+    """Median RGB distance from each palette color to its closest other one."""
+    palette = np.asarray(palette, dtype=np.float32)
+    if len(palette) < 2:
+        return 0.0
+    distances = np.sqrt(((palette[:, None] - palette[None]) ** 2).sum(axis=-1))
+    np.fill_diagonal(distances, np.inf)
+    return float(np.median(distances.min(axis=1)))
+
+
+def nearest_colors(pixels, palette, chunk=65536):
+    """Index of the nearest palette color (RGB distance) for each of (N, 3) pixels."""
+    palette = np.asarray(palette, dtype=np.float32)
+    squared = (palette ** 2).sum(axis=1)
+    labels = np.empty(len(pixels), dtype=np.intp)
+    for start in range(0, len(pixels), chunk):
+        block = pixels[start:start + chunk]
+        # |p - c|^2 without the |p|^2 term, which does not change the argmin
+        labels[start:start + chunk] = (squared - 2 * block @ palette.T).argmin(axis=1)
+    return labels
+
+
+def bayer_dither(image, palette, strength=1.0, size=BAYER_SIZE):
+    """Ordered dithering of an (H, W, 3) RGB image to palette indices.
+
+    The threshold pattern shifts pixels by up to half of strength times the
+    typical distance between palette colors before picking the nearest
+    color, so gradients between two colors become a regular mix of both.
+    """
+    height, width = image.shape[:2]
+    thresholds = np.tile(bayer_matrix(size), (height // size + 1, width // size + 1))[:height, :width]
+    offset = ((thresholds - 0.5) * palette_spacing(palette) * strength).astype(np.float32)
+    shifted = image.astype(np.float32) + offset[..., None]
+    return nearest_colors(shifted.reshape(-1, 3), palette).reshape(height, width)
+
+
+def refine(indices, palette, image=None, dither=0.0, majority=0, iterations=1, min_run=0):
+    """Apply the requested steps to an index grid.
+
+    Returns (indices, stats) where stats has the time of each step in
+    seconds, the number of changed stitches and isolated stitches before
+    and after. dither is a strength (0 for none) and needs the resized RGB
+    image; majority is a filter size (0 for none).
+    """
+    stats = {'timings': {}}
+    labels = np.asarray(indices)
+    num_colors = len(palette)
+
+    def timed(step, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        stats['timings'][step] = time.perf_counter() - start
+        metrics.record_span(f'refine.{step}', stats['timings'][step])
+        return result
+
+    if dither:
+        if image is None:
+            raise ValueError("Dithering needs the source image")
+        labels = timed('dither', bayer_dither, image, palette, dither)
+    if majority:
+        labels = timed('majority', majority_filter, labels, num_colors, majority, iterations)
+    if min_run > 1:
+        labels = timed('min_run', enforce_min_run, labels, min_run)
+    stats['changed'] = int(np.count_nonzero(labels != indices))
+    stats['isolated_before'] = isolated_stitches(indices)
+    stats['isolated_after'] = isolated_stitches(labels)
+    return labels, stats
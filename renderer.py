@@ -0,0 +1,653 @@
+"""Vectorized NumPy renderer for knitting pattern charts.
+
+The chart is built as a single array instead of issuing several PIL calls
+per stitch. Every palette entry gets one pre-rendered cell tile (fill,
+outline and its number from a pre-rasterized glyph atlas), the whole grid is
+painted from those tiles with one fancy-index blit, and grid lines and
+borders are strided slice writes.
+
+The canvas holds palette codes rather than RGB (see ChartPalette), so charts
+are saved as palette ("P" mode) PNGs. Changing a pattern color only changes
+the palette, and recolor_png swaps it in an encoded PNG without touching the
+pixel data. ChartLayers keeps the layers of a chart between renders so
+toggling numbers or re-exporting only composites what changed. Very large
+charts are never held whole: ChartLayers.region renders any window from the
+cell tiles, which backs both map-style tiles and band-by-band PNG export.
+"""
+import io
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import metrics
+from fonts import font_cache
+from pngwriter import png_chunk, write_png
+
+TILE_SIZE = 256
+MAX_ZOOM = 3  # tiles at MAX_ZOOM are drawn at full chart resolution
+BAND_ROWS = 256
+
+
+class ChartPalette:
+    """Canvas codes for a chart: the pattern colors, then a gray ramp.
+
+    Codes 0..N-1 are the pattern colors. The remaining codes run from white
+    (self.white) to black (self.black) and carry grid lines, borders and
+    antialiased text, so the same codes stay valid when colors change.
+    """
+
+    def __init__(self, colors):
+        self.num_colors = len(colors)
+        self.levels = max(256 - self.num_colors, 64)
+        self.white = self.num_colors
+        self.black = self.num_colors + self.levels - 1
+        self.size = self.num_colors + self.levels
+        self.dtype = np.uint8 if self.size <= 256 else np.uint16
+        # Gray value of each ramp code, white first
+        self.ramp = (255 - np.round(np.arange(self.levels) * 255 / (self.levels - 1))).astype(np.int32)
+        self.rgb = np.empty((self.size, 3), dtype=np.uint8)
+        for i, color in enumerate(colors):
+            self.rgb[i] = [int(c) for c in color['rgb']]
+        self.rgb[self.num_colors:] = self.ramp[:, None]
+
+    def gray_codes(self, values):
+        """Codes of the ramp entries closest to the given gray values."""
+        steps = np.round((255 - values) * (self.levels - 1) / 255).astype(np.int32)
+        return steps + self.white
+
+    def palette_bytes(self):
+        """Palette for a P mode image (only valid when self.size <= 256)."""
+        return self.rgb.tobytes()
+
+    def image(self, canvas):
+        """Convert a code canvas to a PIL image, in P mode when the codes fit."""
+        if self.dtype == np.uint8:
+            image = Image.fromarray(canvas, mode='P')
+            image.putpalette(self.palette_bytes())
+            return image
+        return Image.fromarray(self.rgb[canvas])
+
+
+def blend_ink(dst, alpha, palette):
+    """Blend black ink with coverage alpha into a code canvas in place.
+
+    Over white and gray codes the result matches PIL's fixed-point BLEND,
+    rounded to the nearest ramp entry. Over a pattern color, ink covering at
+    least half the pixel turns it black and lighter ink leaves it alone.
+    """
+    codes = dst.astype(np.int32)
+    alpha = alpha.astype(np.int32)
+    gray = codes >= palette.white
+    values = palette.ramp[np.clip(codes - palette.white, 0, palette.levels - 1)]
+    tmp = values * (255 - alpha) + 128
+    blended = palette.gray_codes((tmp + (tmp >> 8)) >> 8)
+    over_color = np.where(alpha >= 128, palette.black, codes)
+    dst[...] = np.where(gray, blended, over_color)
+
+
+def blit_text(canvas, text, size, x, y, palette):
+    """Draw black text at (x, y) as ImageDraw.text would place it."""
+    alpha, ox, oy, _ = font_cache.glyph(text, size)
+    _blit_alpha(canvas, alpha, x + ox, y + oy, palette)
+
+
+def _blit_alpha(canvas, alpha, x, y, palette):
+    height, width = canvas.shape[:2]
+    y0, x0 = max(y, 0), max(x, 0)
+    y1, x1 = min(y + alpha.shape[0], height), min(x + alpha.shape[1], width)
+    if y0 >= y1 or x0 >= x1:
+        return
+    blend_ink(canvas[y0:y1, x0:x1], alpha[y0 - y:y1 - y, x0 - x:x1 - x], palette)
+
+
+def build_number_atlas(labels, size, scale, padding):
+    """Pre-rasterize one cell-sized number stamp per palette entry.
+
+    Each stamp holds the white background box and the glyph alpha positioned
+    relative to the cell origin. A label of None produces an empty stamp.
+    Anything falling outside the cell is clipped.
+    """
+    count = len(labels)
+    backgrounds = np.zeros((count, scale, scale), dtype=bool)
+    alphas = np.zeros((count, scale, scale), dtype=np.uint8)
+    for i, label in enumerate(labels):
+        if label is None:
+            continue
+        alpha, ox, oy, bbox = font_cache.glyph(label, size)
+        text_width = int(bbox[2] - bbox[0])
+        text_height = int(bbox[3] - bbox[1])
+        text_x = (scale - text_width) // 2
+        text_y = (scale - text_height) // 2
+
+        # White box behind the number (PIL rectangles include both corners)
+        bx0, by0 = max(text_x - padding, 0), max(text_y - padding, 0)
+        bx1 = min(text_x + text_width + padding + 1, scale)
+        by1 = min(text_y + text_height + padding + 1, scale)
+        backgrounds[i, by0:by1, bx0:bx1] = True
+
+        # Glyph alpha, clipped to the cell
+        gx, gy = text_x + ox, text_y + oy
+        cx0, cy0 = max(gx, 0), max(gy, 0)
+        cx1 = min(gx + alpha.shape[1], scale)
+        cy1 = min(gy + alpha.shape[0], scale)
+        if cx0 < cx1 and cy0 < cy1:
+            alphas[i, cy0:cy1, cx0:cx1] = alpha[cy0 - gy:cy1 - gy, cx0 - gx:cx1 - gx]
+    return backgrounds, alphas
+
+
+def build_cell_tiles(fills, scale, outlined, palette, backgrounds=None, alphas=None):
+    """Render one complete scale x scale cell per entry of fills (codes).
+
+    outlined is a per-entry bool array choosing which tiles get the 1px black
+    cell outline; backgrounds/alphas are an optional number atlas from
+    build_number_atlas stamped on top.
+    """
+    tiles = np.empty((len(fills), scale, scale), dtype=palette.dtype)
+    tiles[...] = np.asarray(fills)[:, None, None]
+    edge = np.zeros((scale, scale), dtype=bool)
+    edge[[0, -1], :] = True
+    edge[:, [0, -1]] = True
+    tiles[outlined[:, None, None] & edge] = palette.black
+    if backgrounds is not None:
+        tiles[backgrounds] = palette.white
+        blend_ink(tiles, alphas, palette)
+    return tiles
+
+
+def paint_cells(canvas, pattern_indices, tiles, x, y):
+    """Paint every cell from the tile atlas with a single fancy-index blit."""
+    height, width = pattern_indices.shape
+    scale = tiles.shape[1]
+    # (tile row, entry, tile col) so the gather lands in canvas row order
+    rows = tiles.transpose(1, 0, 2)
+    cells = rows[np.arange(scale)[None, :, None], pattern_indices[:, None, :]]
+    block = canvas[y:y + height * scale, x:x + width * scale]
+    block.reshape(height, scale, width, scale)[...] = cells
+
+
+def border_regions(x0, y0, x1, y1, width):
+    """Slices of a rectangle outline growing inward from the inclusive box."""
+    return [
+        (slice(y0, y0 + width), slice(x0, x1 + 1)),
+        (slice(y1 - width + 1, y1 + 1), slice(x0, x1 + 1)),
+        (slice(y0, y1 + 1), slice(x0, x0 + width)),
+        (slice(y0, y1 + 1), slice(x1 - width + 1, x1 + 1)),
+    ]
+
+
+def recolor_png(png, colors):
+    """Return png (a chart rendered for the same number of colors) with new colors.
+
+    Only the PLTE chunk is rewritten; the compressed pixel data is reused.
+    Returns None when png has no palette to replace.
+    """
+    palette = ChartPalette(colors)
+    if palette.dtype != np.uint8:
+        return None
+    data = palette.palette_bytes()
+    chunks = [png[:8]]
+    position = 8
+    replaced = False
+    while position < len(png):
+        length, chunk_type = struct.unpack('>I4s', png[position:position + 8])
+        end = position + 12 + length
+        if chunk_type == b'PLTE':
+            if length != len(data):
+                return None
+            chunks.append(png_chunk(chunk_type, data))
+            replaced = True
+        else:
+            chunks.append(png[position:end])
+        position = end
+    return b''.join(chunks) if replaced else None
+
+
+def _clip_slice(region, low, high):
+    """Shift a (possibly strided) slice to a window [low, high) of its axis."""
+    start, stop, step = region.start, region.stop, region.step or 1
+    if start < low:
+        start += -(-(low - start) // step) * step
+    return slice(start - low, max(min(stop, high) - low, 0), step)
+
+
+def chart_layout(kind, scale=20):
+    """Geometry and text sizes of the on-screen preview or the printable chart."""
+    if kind == 'preview':
+        return {'kind': kind, 'scale': scale, 'margin': 80, 'bottom_margin': 50,
+                'number_size': int(scale * 0.4), 'padding': 2, 'label_size': 10}
+    if kind == 'chart':
+        return {'kind': kind, 'scale': 30, 'margin': 100, 'bottom_margin': 50,
+                'number_size': 15, 'padding': 3, 'label_size': 16}
+    raise ValueError(f"Unknown chart kind: {kind}")
+
+
+class ChartLayers:
+    """Cached render layers of one pattern's preview or chart.
+
+    The image is composited from four layers: the color cells, the number
+    overlay (the cells with their numbers stamped on), the grid lines, border
+    and ticks, and the axis labels. A layer is only rebuilt when its inputs
+    change. Color edits never rebuild anything since the canvas holds
+    palette codes, and the encoded PNG of each numbers setting is kept so
+    re-exports reuse it, swapping its palette when colors changed.
+
+    last describes the latest png() or image() call: the layers rebuilt
+    with their seconds and the composite/encode times.
+    """
+
+    LAYERS = ('cells', 'numbers', 'grid', 'axes', 'cell_tiles', 'number_tiles')
+
+    def __init__(self, kind='chart', scale=20, max_composite_pixels=32 * 1024 * 1024):
+        self.layout = chart_layout(kind, scale)
+        self.max_composite_pixels = max_composite_pixels
+        self.indices = None
+        self.colors = None
+        self.palette = None
+        self.version = 0
+        self._layers = {}  # name -> (key, value)
+        self._png = {}  # (show_numbers, compress level) -> (key, rgb values, png bytes)
+        self._lock = threading.RLock()
+        self.rebuilds = dict.fromkeys(self.LAYERS, 0)
+        self.rebuild_seconds = dict.fromkeys(self.LAYERS, 0.0)
+        self.last = {'rebuilt': {}}
+
+    def set_pattern(self, pattern_indices, colors):
+        """Point the layers at a pattern, invalidating what its changes touch."""
+        indices = np.asarray(pattern_indices)
+        with self._lock:
+            same = (self.indices is not None and self.palette.num_colors == len(colors)
+                    and (indices is self.indices or np.array_equal(indices, self.indices)))
+            if not same:
+                self.indices = indices.copy()
+                # Indices without a matching color are left white and unnumbered
+                cell_index = self.indices.astype(np.intp)
+                missing = (cell_index < 0) | (cell_index >= len(colors))
+                self.cell_index = np.where(missing, len(colors), cell_index)
+                self.version += 1
+            self.colors = colors
+            self.palette = ChartPalette(colors)
+
+    @contextmanager
+    def pinned(self, pattern_indices, colors):
+        """set_pattern, holding the layers on that pattern until the block ends.
+
+        Renders inside the block cannot pick up a pattern set by another
+        thread in between; other threads wait for the block instead.
+        """
+        with self._lock:
+            self.set_pattern(pattern_indices, colors)
+            yield self
+
+    @property
+    def nbytes(self):
+        total = sum(value.nbytes for _, value in self._layers.values() if isinstance(value, np.ndarray))
+        return total + sum(len(png) for _, _, png in self._png.values())
+
+    def _layer(self, name, key, build):
+        entry = self._layers.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        start = time.perf_counter()
+        value = build()
+        seconds = time.perf_counter() - start
+        self._layers[name] = (key, value)
+        self.rebuilds[name] += 1
+        self.rebuild_seconds[name] += seconds
+        self.last['rebuilt'][name] = seconds
+        metrics.record_span(f"render.{self.layout['kind']}.{name}", seconds)
+        return value
+
+    def _labels(self):
+        if self.layout['kind'] == 'preview':
+            return tuple(str(color['number']) for color in self.colors)
+        return tuple(str(i + 1) for i in range(len(self.colors)))
+
+    def canvas_size(self):
+        layout = self.layout
+        height, width = self.indices.shape
+        return (height * layout['scale'] + layout['margin'] + layout['bottom_margin'],
+                width * layout['scale'] + 2 * layout['margin'])
+
+    def _tiles(self, labels):
+        """Cell tile atlas, numbered when labels are given."""
+        def build():
+            layout, palette = self.layout, self.palette
+            num_colors = palette.num_colors
+            fills = np.append(np.arange(num_colors), palette.white)
+            outlined = np.arange(len(fills)) < num_colors
+            atlas = (None, None)
+            if labels is not None:
+                atlas = build_number_atlas(list(labels) + [None], layout['number_size'],
+                                           layout['scale'], layout['padding'])
+            return build_cell_tiles(fills, layout['scale'], outlined, palette, *atlas)
+        name = 'cell_tiles' if labels is None else 'number_tiles'
+        return self._layer(name, (self.palette.num_colors, labels), build)
+
+    def _build_cells(self, labels):
+        """Paint the cell block, with numbers when labels are given."""
+        scale = self.layout['scale']
+        height, width = self.cell_index.shape
+        block = np.empty((height * scale, width * scale), dtype=self.palette.dtype)
+        paint_cells(block, self.cell_index, self._tiles(labels), 0, 0)
+        return block
+
+    def _build_grid(self):
+        """Slices painted black over the cells: grid lines, border and ticks."""
+        layout = self.layout
+        scale, margin = layout['scale'], layout['margin']
+        height, width = self.indices.shape
+        right = margin + width * scale
+        bottom = margin + height * scale
+        if layout['kind'] == 'preview':
+            return [
+                (slice(margin + scale // 2, bottom, scale), slice(right, right + 6)),
+                (slice(bottom, bottom + 6), slice(margin + scale // 2, right, scale)),
+            ] + border_regions(margin, margin, right - 1, bottom - 1, 2)
+
+        # Grid lines are 2px wide, starting at each cell boundary
+        regions = []
+        for offset in (0, 1):
+            regions.append((slice(margin, bottom + 1), slice(margin + offset, right + offset + 1, scale)))
+            regions.append((slice(margin + offset, bottom + offset + 1, scale), slice(margin, right + 1)))
+        border_width = 3
+        regions += border_regions(margin - border_width, margin - border_width,
+                                  right + border_width, bottom + border_width, border_width)
+        for offset in (0, 1):
+            regions.append((slice(bottom, bottom + 6), slice(margin + scale // 2 + offset, right, scale)))
+        return regions
+
+    def _build_axes(self):
+        """White canvas with the row and column numbers in the margins."""
+        canvas = np.full(self.canvas_size(), self.palette.white, dtype=self.palette.dtype)
+        self._draw_axes(canvas)
+        return canvas
+
+    def _draw_axes(self, canvas, top=0, left=0):
+        """Draw the axis numbers onto canvas, whose origin is (left, top) on the chart."""
+        layout, palette = self.layout, self.palette
+        scale, margin, label_size = layout['scale'], layout['margin'], layout['label_size']
+        height, width = self.indices.shape
+        right = margin + width * scale
+        bottom = margin + height * scale
+        window_bottom = top + canvas.shape[0]
+        window_right = left + canvas.shape[1]
+
+        def visible(y):
+            return y - 2 * label_size < window_bottom and y + 2 * label_size > top
+
+        preview = layout['kind'] == 'preview'
+        if window_right > right:
+            for i in range(height):
+                if preview:
+                    # Rows count from bottom to top on the right
+                    number = str(i + 1)
+                    x, y = right + 10, (height - i - 1) * scale + margin + scale // 2 - 5
+                else:
+                    # Y-axis numbers (starting from bottom)
+                    number = str(height - i)
+                    x, y = right + 15, margin + i * scale
+                if not visible(y):
+                    continue
+                if not preview:
+                    bbox = font_cache.bbox(number, label_size)
+                    y += (scale - int(bbox[3] - bbox[1])) // 2
+                blit_text(canvas, number, label_size, x - left, y - top, palette)
+
+        if window_bottom > bottom:
+            for i in range(width):
+                if preview:
+                    # Columns count from right to left
+                    number = str(i + 1)
+                    x, y = (width - i - 1) * scale + margin + scale // 2, bottom + 8
+                else:
+                    # X-axis numbers (starting from right)
+                    number = str(width - i)
+                    x, y = margin + i * scale, bottom + 10
+                reach = label_size * len(number) + scale
+                if not (x - reach < window_right and x + reach > left):
+                    continue
+                bbox = font_cache.bbox(number, label_size)
+                text_width = int(bbox[2] - bbox[0])
+                x += (scale - text_width) // 2 if not preview else -(text_width // 2)
+                blit_text(canvas, number, label_size, x - left, y - top, palette)
+
+    def _composite(self, show_numbers):
+        version, num_colors = self.version, self.palette.num_colors
+        shape = self.indices.shape
+        canvas = self._layer('axes', (shape, num_colors), self._build_axes).copy()
+        if show_numbers:
+            labels = self._labels()
+            block = self._layer('numbers', (version, labels), lambda: self._build_cells(labels))
+        else:
+            block = self._layer('cells', version, lambda: self._build_cells(None))
+        margin = self.layout['margin']
+        canvas[margin:margin + block.shape[0], margin:margin + block.shape[1]] = block
+        for region in self._layer('grid', shape, self._build_grid):
+            canvas[region] = self.palette.black
+        return canvas
+
+    def region(self, top, bottom, left, right, show_numbers=True):
+        """Codes of the chart pixels in rows [top, bottom) and columns [left, right).
+
+        Built straight from the cell tiles, without the full-size layers, so
+        it costs memory proportional to the region only. Parts of the region
+        outside the chart are white.
+        """
+        layout, palette = self.layout, self.palette
+        scale, margin = layout['scale'], layout['margin']
+        canvas = np.full((bottom - top, right - left), palette.white, dtype=palette.dtype)
+        self._draw_axes(canvas, top, left)
+
+        # Cells overlapping the region, painted into an aligned block and cropped
+        height, width = self.cell_index.shape
+        row0, row1 = max((top - margin) // scale, 0), min(-(-(bottom - margin) // scale), height)
+        col0, col1 = max((left - margin) // scale, 0), min(-(-(right - margin) // scale), width)
+        if row0 < row1 and col0 < col1:
+            tiles = self._tiles(self._labels() if show_numbers else None)
+            block = np.empty(((row1 - row0) * scale, (col1 - col0) * scale), dtype=palette.dtype)
+            paint_cells(block, self.cell_index[row0:row1, col0:col1], tiles, 0, 0)
+            block_top, block_left = margin + row0 * scale, margin + col0 * scale
+            y0, y1 = max(top, block_top), min(bottom, block_top + block.shape[0])
+            x0, x1 = max(left, block_left), min(right, block_left + block.shape[1])
+            canvas[y0 - top:y1 - top, x0 - left:x1 - left] = \
+                block[y0 - block_top:y1 - block_top, x0 - block_left:x1 - block_left]
+
+        for rows, cols in self._layer('grid', self.indices.shape, self._build_grid):
+            canvas[_clip_slice(rows, top, bottom), _clip_slice(cols, left, right)] = palette.black
+        return canvas
+
+    def tile_grid(self, zoom):
+        """(columns, rows) of TILE_SIZE tiles covering the chart at a zoom level."""
+        span = TILE_SIZE * 2 ** (MAX_ZOOM - zoom)
+        height, width = self.canvas_size()
+        return -(-width // span), -(-height // span)
+
+    def tile(self, zoom, x, y, show_numbers=True):
+        """TILE_SIZE square PIL image of tile (x, y), or None outside the chart.
+
+        Each zoom level below MAX_ZOOM halves the resolution; those tiles are
+        box-filtered from the full-resolution region they cover.
+        """
+        with self._lock:
+            self._start()
+            columns, rows = self.tile_grid(zoom)
+            if not (0 <= zoom <= MAX_ZOOM and 0 <= x < columns and 0 <= y < rows):
+                return None
+            factor = 2 ** (MAX_ZOOM - zoom)
+            span = TILE_SIZE * factor
+            start = time.perf_counter()
+            codes = self.region(y * span, (y + 1) * span, x * span, (x + 1) * span, show_numbers)
+            image = self.palette.image(codes)
+            if factor > 1:
+                image = image.convert('RGB').reduce(factor)
+            self.last['composite'] = time.perf_counter() - start
+            metrics.record_span(f"render.{self.layout['kind']}.tile", self.last['composite'])
+            return image
+
+    def _bands(self, show_numbers):
+        """Row bands of the chart codes, from the cached layers when they fit."""
+        height, width = self.canvas_size()
+        if height * width <= self.max_composite_pixels:
+            canvas = self._composite(show_numbers)
+            for top in range(0, height, BAND_ROWS):
+                yield canvas[top:top + BAND_ROWS]
+            return
+        self.last['streamed'] = True
+        for top in range(0, height, BAND_ROWS):
+            yield self.region(top, min(top + BAND_ROWS, height), 0, width, show_numbers)
+
+    def write_png(self, file, show_numbers=True, compress_level=6):
+        """Stream the chart as a PNG into a binary file object."""
+        height, width = self.canvas_size()
+        palette = self.palette
+        bands = self._bands(show_numbers)
+        if palette.dtype == np.uint8:
+            write_png(file, width, height, bands, palette=palette.rgb, compress_level=compress_level)
+        else:
+            write_png(file, width, height, (palette.rgb[band] for band in bands), compress_level=compress_level)
+
+    def page_grid(self, rows, columns):
+        """Split the chart into pages of at most rows x columns stitches.
+
+        Returns ((top, bottom, left, right), (row0, row1, col0, col1)) per
+        page in reading order: canvas pixel bounds, then the cell rows and
+        columns on it. Page edges fall on cell edges; the outer pages also
+        take the chart's margins and axis labels.
+        """
+        layout = self.layout
+        scale, margin = layout['scale'], layout['margin']
+        height, width = self.indices.shape
+        canvas_height, canvas_width = self.canvas_size()
+
+        def cuts(cells, step, canvas):
+            starts = list(range(0, cells, step))
+            edges = [0] + [margin + start * scale for start in starts[1:]] + [canvas]
+            return [(edges[i], edges[i + 1], start, min(start + step, cells)) for i, start in enumerate(starts)]
+
+        return [((top, bottom, left, right), (row0, row1, col0, col1))
+                for top, bottom, row0, row1 in cuts(height, rows, canvas_height)
+                for left, right, col0, col1 in cuts(width, columns, canvas_width)]
+
+    def page(self, bounds, show_numbers=True):
+        """Codes of one page of page_grid, rendered with region()."""
+        with self._lock:
+            return self.region(*bounds, show_numbers)
+
+    def _start(self):
+        self.last = {'rebuilt': {}}
+
+    def image(self, show_numbers=True):
+        """Composite the layers into a PIL image."""
+        with self._lock:
+            self._start()
+            start = time.perf_counter()
+            image = self.palette.image(self._composite(show_numbers))
+            self.last['composite'] = time.perf_counter() - start
+            metrics.record_span(f"render.{self.layout['kind']}.composite", self.last['composite'])
+            return image
+
+    def png(self, show_numbers=True, compress_level=6):
+        """Encoded PNG of the current pattern and colors.
+
+        Charts larger than max_composite_pixels are encoded band by band
+        from region() instead of from the full-size layers.
+        """
+        with self._lock:
+            self._start()
+            key = (self.version, self._labels())
+            rgb = self.palette.rgb.tobytes()
+            slot = (bool(show_numbers), compress_level)
+            entry = self._png.get(slot)
+            if entry is not None and entry[0] == key:
+                if entry[1] == rgb:
+                    self.last['reused'] = True
+                    return entry[2]
+                png = recolor_png(entry[2], self.colors)
+                if png is not None:
+                    self.last['recolored'] = True
+                    self._png[slot] = (key, rgb, png)
+                    return png
+
+            start = time.perf_counter()
+            buffer = io.BytesIO()
+            self.write_png(buffer, show_numbers, compress_level)
+            png = buffer.getvalue()
+            self.last['encode'] = time.perf_counter() - start
+            metrics.record_span(f"encode.{self.layout['kind']}", self.last['encode'])
+            self._png[slot] = (key, rgb, png)
+            return png
+
+    def stats(self):
+        return {
+            'kind': self.layout['kind'],
+            'bytes': self.nbytes,
+            'rebuilds': dict(self.rebuilds),
+            'rebuild_seconds': dict(self.rebuild_seconds),
+            'last': self.last,
+        }
+
+
+def render_preview(pattern_indices, colors, scale=20, show_numbers=True):
+    """Render the on-screen pattern preview (outlined cells, ticks on the right and bottom)."""
+    layers = ChartLayers('preview', scale)
+    layers.set_pattern(pattern_indices, colors)
+    return layers.image(show_numbers)
+
+
+def render_chart(pattern_indices, colors, show_numbers=True):
+    """Render the full-size printable chart (thick grid lines and axis numbers)."""
+    layers = ChartLayers('chart')
+    layers.set_pattern(pattern_indices, colors)
+    return layers.image(show_numbers)
+
+
+def render_color_list(colors):
+    """Render the color list: a swatch and RGB values per color."""
+    # Create a new image with white background
+    img_width = 400
+    img_height = 100 + len(colors) * 60
+    img = Image.new('RGB', (img_width, img_height), 'white')
+    draw = ImageDraw.Draw(img)
+
+    # Draw title
+    draw.text((20, 20), "Color List", fill='black', font=font_cache.font(24))
+
+    # Draw each color
+    for i, color in enumerate(colors):
+        y = 80 + i * 60
+        # Draw color sample
+        draw.rectangle([20, y, 70, y + 50], fill=tuple(color['rgb']), outline='black')
+        # Draw color number and RGB values
+        text = f"Color {i + 1}: RGB({color['rgb'][0]}, {color['rgb'][1]}, {color['rgb'][2]})"
+        draw.text((90, y + 15), text, fill='black', font=font_cache.font(16))
+    return img
+
+
+def render_gauge(width, height):
+    """Render the gauge calculation for a pattern of width x height stitches."""
+    # Create a new image with white background
+    img = Image.new('RGB', (400, 300), 'white')
+    draw = ImageDraw.Draw(img)
+
+    # Draw title
+    draw.text((20, 20), "Gauge Calculation", fill='black', font=font_cache.font(24))
+
+    # Draw gauge information
+    y = 80
+    draw.text((20, y), "Standard Gauge: 17 × 22", fill='black', font=font_cache.font(16))
+
+    y += 40
+    draw.text((20, y), f"Pattern Size: {width} × {height} stitches",
+              fill='black', font=font_cache.font(16))
+
+    y += 40
+    # Calculate physical dimensions
+    physical_width = (width / 17) * 10
+    physical_height = (height / 22) * 10
+    draw.text((20, y), f"Estimated Size: {physical_width:.1f} × {physical_height:.1f} cm",
+              fill='black', font=font_cache.font(16))
+    return img
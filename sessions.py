@@ -0,0 +1,295 @@
+"""Session-scoped pattern store.
+
+Each browser session gets its own pattern state instead of sharing module
+globals. States live in process memory with an idle TTL and a total memory
+cap. With a spill directory configured, every state is also written to disk:
+states evicted for memory are reloaded on their next request, and separate
+worker processes sharing the directory see each other's updates. Spilled
+patterns use the binary format of pattern.py, so reloading one memory-maps
+its index grid instead of parsing it. Generated variants that a session may
+pick later are spilled too, under variants/, so any worker can load them.
+"""
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from cache import sizeof
+from pattern import load_pattern, save_pattern
+
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+VARIANT_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def is_session_id(value):
+    """True for ids produced by new_session_id (safe to use in paths)."""
+    return bool(value) and SESSION_ID_PATTERN.match(value) is not None
+
+
+def _as_tuple(value):
+    """A cache key read back from JSON, with its lists turned into tuples again."""
+    if isinstance(value, list):
+        return tuple(_as_tuple(v) for v in value)
+    return value
+
+
+class PatternStore:
+    """Pattern state per session id with TTL, memory cap and optional disk spill.
+
+    A state is a dict with 'pattern' (a pattern.Pattern) and 'show_numbers',
+    plus optionally 'preview', the encoded preview PNG, 'source', the
+    (tuple) result cache key the pattern was generated from, and 'base' and
+    'image', the pattern as generated and the resized image it came from,
+    which refinements start over from.
+    on_expire(session_id) is called when a session is dropped for good.
+    """
+
+    def __init__(self, ttl=3600, max_bytes=512 * 1024 * 1024, spill_dir=None, on_expire=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.on_expire = on_expire
+        self._states = {}  # session id -> [state, size, last access, disk mtime]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.spills = 0
+        self.loads = 0
+        self.expired = 0
+        if spill_dir:
+            os.makedirs(os.path.join(spill_dir, 'variants'), exist_ok=True)
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f'{session_id}.pattern')
+
+    def _preview_path(self, session_id):
+        return os.path.join(self.spill_dir, f'{session_id}.png')
+
+    def _base_path(self, session_id):
+        return os.path.join(self.spill_dir, f'{session_id}.base')
+
+    def _image_path(self, session_id):
+        return os.path.join(self.spill_dir, f'{session_id}.image.npy')
+
+    def _companion_paths(self, session_id):
+        return [self._preview_path(session_id), self._base_path(session_id), self._image_path(session_id)]
+
+    def _variant_path(self, variant_id, ext):
+        return os.path.join(self.spill_dir, 'variants', f'{variant_id}{ext}')
+
+    def _write_file(self, path, value, write):
+        """Atomically write value with write(file, value), or remove path if value is None."""
+        if value is None:
+            self._unlink(path)
+            return
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            write(f, value)
+        os.replace(tmp_path, path)
+
+    def _write_spill(self, session_id, state):
+        # The other files go first: the pattern file's mtime marks the update
+        self._write_file(self._preview_path(session_id), state.get('preview'), lambda f, data: f.write(data))
+        self._write_file(self._base_path(session_id), state.get('base'), save_pattern)
+        self._write_file(self._image_path(session_id), state.get('image'), np.save)
+        path = self._spill_path(session_id)
+        self._write_file(path, state['pattern'], lambda f, pattern: save_pattern(
+            f, pattern, meta={'show_numbers': state['show_numbers'], 'source': state.get('source')}))
+        return os.path.getmtime(path)
+
+    def _read_spill(self, session_id):
+        pattern, meta = load_pattern(self._spill_path(session_id))
+        try:
+            with open(self._preview_path(session_id), 'rb') as f:
+                preview = f.read()
+        except OSError:
+            preview = None
+        try:
+            base = load_pattern(self._base_path(session_id))[0]
+        except OSError:
+            base = None
+        try:
+            image = np.load(self._image_path(session_id), mmap_mode='r')
+        except OSError:
+            image = None
+        meta = meta or {}
+        return {'pattern': pattern, 'show_numbers': meta.get('show_numbers', True), 'preview': preview,
+                'source': _as_tuple(meta.get('source')), 'base': base, 'image': image}
+
+    def put_variant(self, variant_id, result, key):
+        """Spill a generated variant's 'pattern' and 'image' under variant_id.
+
+        key is the (tuple) result cache key it was generated under. Does
+        nothing without a spill directory.
+        """
+        if not self.spill_dir or not VARIANT_ID_PATTERN.match(variant_id):
+            return
+        # The image goes first: the pattern file marks a complete variant
+        self._write_file(self._variant_path(variant_id, '.image.npy'), result.get('image'), np.save)
+        self._write_file(self._variant_path(variant_id, '.pattern'), result['pattern'],
+                         lambda f, pattern: save_pattern(f, pattern, meta={'key': key}))
+
+    def get_variant(self, variant_id):
+        """(result, key) of a variant spilled by any worker, or None."""
+        if not self.spill_dir or not VARIANT_ID_PATTERN.match(variant_id):
+            return None
+        try:
+            pattern, meta = load_pattern(self._variant_path(variant_id, '.pattern'))
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            image = np.load(self._variant_path(variant_id, '.image.npy'), mmap_mode='r')
+        except OSError:
+            image = None
+        return {'pattern': pattern, 'image': image}, _as_tuple((meta or {}).get('key'))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _disk_mtime(self, session_id):
+        try:
+            return os.path.getmtime(self._spill_path(session_id))
+        except OSError:
+            return None
+
+    def get(self, session_id):
+        """State for session_id, or None if it has none."""
+        self._maybe_sweep()
+        mtime = self._disk_mtime(session_id) if self.spill_dir else None
+        with self._lock:
+            entry = self._states.get(session_id)
+            if entry is not None and (mtime is None or mtime <= entry[3]):
+                entry[2] = time.monotonic()
+                return entry[0]
+        if mtime is None:
+            return None
+
+        # Evicted from memory, or updated by another worker
+        try:
+            state = self._read_spill(session_id)
+        except (OSError, ValueError, KeyError):
+            return None
+        self.loads += 1
+        self._remember(session_id, state, mtime)
+        return state
+
+    def has(self, session_id):
+        """True if session_id has a state in memory or spilled by any worker."""
+        with self._lock:
+            if session_id in self._states:
+                return True
+        return bool(self.spill_dir) and self._disk_mtime(session_id) is not None
+
+    def put(self, session_id, state):
+        """Store (or replace) the state of session_id."""
+        mtime = self._write_spill(session_id, state) if self.spill_dir else 0.0
+        self._remember(session_id, state, mtime)
+        self._maybe_sweep()
+
+    def _remember(self, session_id, state, mtime):
+        size = sizeof(state)
+        with self._lock:
+            old = self._states.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._states[session_id] = [state, size, time.monotonic(), mtime]
+            self._bytes += size
+            self._enforce_cap(keep=session_id)
+
+    def _enforce_cap(self, keep):
+        """Drop least recently used states until under the memory cap."""
+        if self._bytes <= self.max_bytes:
+            return
+        for session_id in sorted(self._states, key=lambda s: self._states[s][2]):
+            if self._bytes <= self.max_bytes:
+                break
+            if session_id == keep:
+                continue
+            _, size, _, _ = self._states.pop(session_id)
+            self._bytes -= size
+            if self.spill_dir:
+                self.spills += 1  # already on disk, reloaded on next get
+            else:
+                self.expired += 1
+                self._expire_callback(session_id)
+
+    def delete(self, session_id):
+        """Forget a session entirely."""
+        with self._lock:
+            entry = self._states.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+        if self.spill_dir:
+            self._unlink(self._spill_path(session_id))
+            for path in self._companion_paths(session_id):
+                self._unlink(path)
+
+    def _expire_callback(self, session_id):
+        if self.on_expire is not None:
+            self.on_expire(session_id)
+
+    def _maybe_sweep(self, interval=60):
+        now = time.monotonic()
+        if now - self._last_sweep >= interval:
+            self._last_sweep = now
+            self.sweep()
+
+    def sweep(self):
+        """Drop sessions idle for longer than the TTL."""
+        deadline = time.monotonic() - self.ttl
+        with self._lock:
+            idle = [s for s, entry in self._states.items() if entry[2] < deadline]
+            for session_id in idle:
+                self._bytes -= self._states.pop(session_id)[1]
+        if self.spill_dir:
+            # Spilled sessions live on until the TTL runs out on disk, counted
+            # from the last write by any worker
+            idle = []
+            disk_deadline = time.time() - self.ttl
+            for name in os.listdir(self.spill_dir):
+                session_id, ext = os.path.splitext(name)
+                path = os.path.join(self.spill_dir, name)
+                if ext == '.pattern' and is_session_id(session_id) and os.path.getmtime(path) < disk_deadline:
+                    os.unlink(path)
+                    for companion in self._companion_paths(session_id):
+                        self._unlink(companion)
+                    idle.append(session_id)
+            variants_dir = os.path.join(self.spill_dir, 'variants')
+            for name in os.listdir(variants_dir):
+                path = os.path.join(variants_dir, name)
+                if os.path.getmtime(path) < disk_deadline:
+                    self._unlink(path)
+        for session_id in idle:
+            self.expired += 1
+            self._expire_callback(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._states),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'spill_dir': self.spill_dir,
+                'spills': self.spills,
+                'loads': self.loads,
+                'expired': self.expired,
+            }
+
+
+def remove_session_dir(root, session_id):
+    """Delete a session's output directory."""
+    if is_session_id(session_id):
+        shutil.rmtree(os.path.join(root, session_id), ignore_errors=True)
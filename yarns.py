@@ -0,0 +1,163 @@
+"""Yarn color catalog and nearest-yarn matching in CIELAB.
+
+A catalog is a CSV file with the columns id, brand, name and either hex
+(#rrggbb) or r, g and b, or a JSON list of objects with the same keys (or
+an "rgb" list). The yarns' Lab coordinates are indexed by a SciPy KD-tree
+built once when the catalog is loaded, and every lookup is a single batched query: all palette entries when
+snapping a pattern, or all distinct pixel colors when quantizing an image
+against a set of yarns. Matching uses Euclidean
+distance in Lab (CIE76 Delta E).
+"""
+import csv
+import json
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import colorspace
+from pattern import Pattern
+
+
+def parse_hex(value):
+    value = value.strip().lstrip('#')
+    if len(value) != 6:
+        raise ValueError(f"Invalid hex color: {value!r}")
+    return [int(value[i:i + 2], 16) for i in (0, 2, 4)]
+
+
+def parse_yarn(row, position):
+    """Normalize one catalog entry to {'id', 'brand', 'name', 'rgb'}."""
+    if row.get('hex'):
+        rgb = parse_hex(row['hex'])
+    elif row.get('rgb') is not None:
+        rgb = [int(v) for v in row['rgb']]
+    else:
+        rgb = [int(row[channel]) for channel in 'rgb']
+    if len(rgb) != 3 or not all(0 <= v <= 255 for v in rgb):
+        raise ValueError(f"Invalid color for yarn {position}: {rgb}")
+    return {
+        'id': str(row.get('id') or position),
+        'brand': row.get('brand') or '',
+        'name': row.get('name') or '',
+        'rgb': rgb,
+    }
+
+
+def load_catalog(path):
+    """Load a CSV or JSON yarn catalog into a YarnCatalog."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    yarns = []
+    for position, row in enumerate(rows, start=1):
+        try:
+            yarns.append(parse_yarn(row, position))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"{path}: entry {position}: {e}") from None
+    return YarnCatalog(yarns)
+
+
+class YarnCatalog:
+    """Yarns indexed for nearest-color lookups in Lab."""
+
+    def __init__(self, yarns):
+        if not yarns:
+            raise ValueError("A yarn catalog needs at least one yarn")
+        self.yarns = list(yarns)
+        self.ids = {yarn['id']: i for i, yarn in enumerate(self.yarns)}
+        if len(self.ids) != len(self.yarns):
+            raise ValueError("Yarn ids must be unique")
+        self.rgb = np.array([yarn['rgb'] for yarn in self.yarns], dtype=np.uint8)
+        self.lab = colorspace.rgb_to_lab(self.rgb).astype(np.float64)
+        self.tree = cKDTree(self.lab)
+
+    def __len__(self):
+        return len(self.yarns)
+
+    def lookup(self, ids):
+        """The yarns with the given ids, without repeats; KeyError for unknown ids."""
+        missing = [i for i in ids if i not in self.ids]
+        if missing:
+            raise KeyError(f"Unknown yarn ids: {', '.join(missing)}")
+        return [self.yarns[self.ids[i]] for i in dict.fromkeys(ids)]
+
+    def subset(self, ids):
+        """Catalog of just the yarns with the given ids."""
+        return YarnCatalog(self.lookup(ids))
+
+    def search(self, query=None, brand=None, limit=None):
+        """Yarns whose brand or name contains query, optionally of one brand."""
+        query = query.lower() if query else None
+        brand = brand.lower() if brand else None
+        found = []
+        for yarn in self.yarns:
+            if brand and yarn['brand'].lower() != brand:
+                continue
+            if query and query not in yarn['name'].lower() and query not in yarn['brand'].lower() \
+                    and query != yarn['id'].lower():
+                continue
+            found.append(yarn)
+            if limit and len(found) == limit:
+                break
+        return found
+
+    def nearest(self, rgb):
+        """(yarn indices, Delta E) of the closest yarn to each color in rgb (..., 3)."""
+        rgb = np.asarray(rgb, dtype=np.uint8)
+        shape = rgb.shape[:-1]
+        distances, indices = self.tree.query(colorspace.rgb_to_lab(rgb.reshape(-1, 3)))
+        return indices.reshape(shape), distances.reshape(shape)
+
+    def match(self, index, distance=None):
+        """A yarn as returned to clients, with the match distance if given."""
+        yarn = dict(self.yarns[index])
+        if distance is not None:
+            yarn['delta_e'] = round(float(distance), 2)
+        return yarn
+
+    def snap(self, pattern):
+        """Replace each palette color of pattern with its nearest yarn.
+
+        Returns (pattern, yarns): a new Pattern and the matched yarn of each
+        of its colors. Colors that snap to the same yarn are merged, in
+        which case the colors are renumbered.
+        """
+        matches, distances = self.nearest(pattern.palette)
+        _, first, inverse = np.unique(matches, return_index=True, return_inverse=True)
+        if len(first) == len(matches):
+            snapped = Pattern(pattern.indices, self.rgb[matches], pattern.numbers)
+            return snapped, [self.match(i, d) for i, d in zip(matches, distances)]
+
+        # Keep merged colors in the order they first appear in the palette
+        kept = np.sort(first)
+        remap = np.empty(len(first), dtype=np.intp)
+        remap[np.argsort(first)] = np.arange(len(first))
+        indices = remap[inverse][pattern.indices]
+        snapped = Pattern(indices, self.rgb[matches[kept]])
+        return snapped, [self.match(matches[i], distances[i]) for i in kept]
+
+    def quantize_image(self, image):
+        """Map every pixel of an (H, W, 3) image to its nearest yarn.
+
+        Returns (pattern, pattern_indices, colors) like quantize.quantize_image,
+        using only the yarns that occur; each color dict has its 'yarn'.
+        """
+        height, width = image.shape[:2]
+        # Photos repeat colors a lot, so only distinct colors are looked up
+        packed = image.reshape(-1, 3).astype(np.uint32)
+        packed = (packed[:, 0] << 16) | (packed[:, 1] << 8) | packed[:, 2]
+        distinct, pixel_colors = np.unique(packed, return_inverse=True)
+        distinct_rgb = np.stack([distinct >> 16, (distinct >> 8) & 255, distinct & 255], axis=1)
+        matches, distances = self.nearest(distinct_rgb)
+        used, labels = np.unique(matches[pixel_colors], return_inverse=True)
+
+        pattern_indices = labels.reshape(height, width).astype(np.int32)
+        pattern = self.rgb[used][labels].reshape(image.shape)
+        # Worst match per used yarn, reported with it
+        worst = np.zeros(len(used))
+        np.maximum.at(worst, np.searchsorted(used, matches), distances)
+        colors = [{'number': i + 1, 'rgb': self.rgb[yarn].tolist(), 'yarn': self.match(yarn, worst[i])}
+                  for i, yarn in enumerate(used)]
+        return pattern, pattern_indices, colors